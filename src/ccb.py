@@ -1,15 +1,16 @@
 from copy import deepcopy
 from networkx.classes import MultiDiGraph
-from numpy import vectorize
+import numpy as np
 from tqdm import trange
 
-from scm_mab.bandits import play_bandits
+from scm_mab.bandits import bandit_algorithms, check_identification_algorithm, play_bandits
 from scm_mab.model import StructuralCausalModel, default_P_U
+from scm_mab.propagation import SlicePropagation
 from scm_mab.scm_bandits import arm_types, arms_of, new_SCM_to_bandit_machine
-from scm_mab.utils import subseq
+from scm_mab.utils import arm_dtype, subseq, with_default
 from src.examples.example_setup import setup_DynamicIVCD
 from src.utils.dag_utils.graph_functions import get_time_slice_sub_graphs, make_time_slice_causal_diagrams
-from src.utils.postprocess import get_results
+from src.utils.postprocess import get_identification_results, get_results
 from src.utils.transitions import fit_transition_functions, get_transition_pairs
 from src.utils.emissions import fit_emission_functions, get_emission_pairs
 
@@ -29,7 +30,14 @@ class CCB:
         sem_estimator: dict = None,
         observational_samples: dict = None,
         arm_strategy: str = "POMIS",
-        bandit_algorithm: str = "TS",  # Assumes that within time-slice bandit is stationary
+        bandit_algorithm: str = "TS",  # One of bandit_algorithms(), "SW-TS" and "D-UCB" track non-stationary rewards
+        batched: bool = False,  # Play all trials in lockstep in a single process
+        aggregate: bool = False,  # Results hold the means over trials as one row, not (n_trials, horizon) histories
+        warm_start: float = 0.0,  # Discount of the success/failure counts carried over to the next time-slice's prior
+        bandit_options: dict = None,  # Passed on to the bandit algorithm, e.g. window for "SW-TS" or gamma for "D-UCB"
+        confidence: float = None,  # Stop trials once the best arm is identified with this error probability, TS or UCB
+        weighted_states: bool = False,  # Weigh the states carried to the next time-slice by their probability
+        progress: bool = False,  # Show the progress of each time-slice's trials, one update per chunk of trials
     ):
 
         self.T = G.total_time
@@ -66,8 +74,29 @@ class CCB:
         # Bandit settings
         assert arm_strategy in arm_types()
         self.arm_strategy = arm_strategy
-        assert bandit_algorithm in ["TS", "UCB"]
-        self.play_bandit_args = {"T": horizon, "algo": bandit_algorithm, "n_trials": n_trials, "n_jobs": n_jobs}
+        assert bandit_algorithm in bandit_algorithms()
+        if confidence is not None:
+            check_identification_algorithm(bandit_algorithm)
+        self.play_bandit_args = {
+            "T": horizon,
+            "algo": bandit_algorithm,
+            "n_trials": n_trials,
+            "n_jobs": n_jobs,
+            "batched": batched,
+            "aggregate": aggregate,
+            "confidence": confidence,
+            "progress": progress,
+            **with_default(bandit_options, dict()),
+        }
+        assert 0 <= warm_start <= 1
+        if warm_start and confidence is not None:
+            raise ValueError(
+                "warm_start carries over the successes and failures of each arm, which best arm identification (with a "
+                "confidence) does not keep, only the identified arms and stopping times"
+            )
+        self.warm_start = warm_start
+        # Discounted (successes, failures) per arm setting, as found by the previous time-slice's trials (on average)
+        self.carried_SF = dict()
 
         # Results
         self.results = {t: None for t in range(self.T)}
@@ -77,6 +106,9 @@ class CCB:
         # Stores the intervention, and the downstream effect of the intervention, for each time-slice
         self.blanket = {t: None for t in range(self.T)}
         self.interventions = []  #  The per-time-slice best interventions
+        # The time-slices played so far, propagated one time-slice at a time (instead of replaying self.interventions)
+        self.weighted_states = weighted_states
+        self.propagation = None
         self.empty_slice = {V: None for V in time_slice_nodes}
 
     # Play piece-wise stationary SCM-MAB
@@ -101,21 +133,34 @@ class CCB:
             )
 
             #  Convert time-slice SCM to bandit machine
+            if self.propagation is None:
+                self.propagation = SlicePropagation(target_var_only, self.weighted_states)
             mu, arm_setting = new_SCM_to_bandit_machine(
-                self.SCMs[temporal_index], interventions=self.interventions, reward_variable=target_var_only
+                self.SCMs[temporal_index], reward_variable=target_var_only, propagation=self.propagation
             )
             #  Select arm strategy, one of: "POMIS", "MIS", "Brute-force", "All-at-once"
             arm_selected = arms_of(self.arm_strategy, arm_setting, self.SCMs[temporal_index].G, target_var_only)
-            arm_corrector = vectorize(lambda x: arm_selected[x])
+            arm_corrector = np.asarray(arm_selected, dtype=arm_dtype(len(mu)))
 
             # Set the rewards distribution
             self.play_bandit_args["mu"] = subseq(mu, arm_selected)
+            self.play_bandit_args["prior_SF"] = self.prior_SF(arm_setting, arm_selected)
             # Pick action/intervention by playing MAB
-            arm_played, rewards = play_bandits(**self.play_bandit_args)
-            arm_played = arm_corrector(arm_played)
-
-            # Post-process
-            self.results[temporal_index] = get_results(arm_played, rewards, mu)
+            if self.play_bandit_args["confidence"] is not None:
+                # horizon is the budget per trial, which stops once it has identified the best arm
+                arm_identified, stopping_times = play_bandits(**self.play_bandit_args)
+                arm_identified = arm_corrector[arm_identified]
+                self.results[temporal_index] = get_identification_results(arm_identified, stopping_times, mu)
+            elif self.play_bandit_args["aggregate"]:
+                summary = play_bandits(**self.play_bandit_args, mu_star=np.max(mu))
+                self.carry_over(arm_setting, arm_selected, summary.arm_successes, summary.arm_counts)
+                self.results[temporal_index] = summary.results(arm_ids=arm_selected)
+            else:
+                history = play_bandits(**self.play_bandit_args, compact=True)
+                self.carry_over(arm_setting, arm_selected, history.arm_successes(), history.arm_counts())
+
+                # Post-process
+                self.results[temporal_index] = get_results(history.relabeled(arm_corrector), None, mu)
             self.reward_distribution[temporal_index] = mu
             self.arm_setting[temporal_index] = arm_setting
             #  Get index of the best arm
@@ -125,6 +170,7 @@ class CCB:
             # Get the corresponding intervention of that index e.g. {'Z': 0}
             best_intervention = arm_setting[best_arm_idx]
             self.interventions.append(best_intervention)
+            self.propagation.advance(self.SCMs[temporal_index], best_intervention)
 
             # Contains the optimal actions and corresponding output
             # self.blanket[temporal_index] = implement_intervention(
@@ -153,6 +199,34 @@ class CCB:
             #     raise NotImplementedError
             #     # clamped_nodes = self.blanket[temporal_index]
 
+    @staticmethod
+    def setting_key(setting: dict) -> tuple:
+        return tuple(sorted(setting.items()))
+
+    def prior_SF(self, arm_setting: dict, arm_selected: tuple):
+        """ The carried over pseudo-counts of the selected arms, matched by arm setting, or None for a flat prior """
+        if not self.carried_SF:
+            return None
+        S, F = np.zeros((len(arm_selected),)), np.zeros((len(arm_selected),))
+        for i, arm in enumerate(arm_selected):
+            S[i], F[i] = self.carried_SF.get(self.setting_key(arm_setting[arm]), (0.0, 0.0))
+        return S, F
+
+    def carry_over(self, arm_setting: dict, arm_selected: tuple, successes: np.ndarray, plays: np.ndarray):
+        """Keep the discounted per-trial average of the successes and failures of each selected arm (summed over
+        trials), together with the prior these trials started from, for the next time-slice"""
+        if not self.warm_start:
+            return
+        n_trials = self.play_bandit_args["n_trials"]
+        prior = self.play_bandit_args["prior_SF"] or (np.zeros((len(arm_selected),)),) * 2
+        self.carried_SF = {
+            self.setting_key(arm_setting[arm]): (
+                self.warm_start * (prior[0][i] + successes[i] / n_trials),
+                self.warm_start * (prior[1][i] + (plays[i] - successes[i]) / n_trials),
+            )
+            for i, arm in enumerate(arm_selected)
+        }
+
 
 def main():
     """
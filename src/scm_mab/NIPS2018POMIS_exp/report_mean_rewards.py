@@ -1,8 +1,23 @@
 from itertools import product
 
 from scm_mab.NIPS2018POMIS_exp.scm_examples import IV_SCM, simple_markovian_SCM, XYZWST_SCM
+from scm_mab.model import StructuralCausalModel, query_engines
 from scm_mab.utils import combinations
 
+
+def check_background_queries(model):
+    """ Queries naming background variables give the same answers with every engine, with and without joints """
+    reference = StructuralCausalModel(model.G, model.F, model.P_U, model.D, model.more_U, joint_cache_bytes=0)
+    models = [model] + [StructuralCausalModel(model.G, model.F, model.P_U, model.D, model.more_U, engine=engine)
+                        for engine in query_engines()]
+    V, U = sorted(model.G.V), sorted(model.G.U | model.more_U)
+    queries = [((U[0],), dict()), ((V[0],), {U[0]: 1}), ((V[0], U[-1]), dict()), ((U[0],), {V[-1]: 1})]
+    for outcome, condition in queries * 2:  # asked twice, the second time from the joint if cached
+        expected = reference.query(outcome, condition)
+        for M in models:
+            result = M.query(outcome, condition)
+            assert all(abs(result[key] - p) < 1e-9 for key, p in expected.items()), (M.engine, outcome, condition)
+
 if __name__ == '__main__':
     for name, (model, p_u) in [('marc', simple_markovian_SCM(seed=0)),
                                ('iv', IV_SCM(True, seed=0)),
@@ -10,6 +25,7 @@ if __name__ == '__main__':
         print('=========================================================================')
         print(f'========================={str(name).center(23)}=========================')
         print(p_u)
+        check_background_queries(model)
         for x_var in combinations(model.G.V - {'Y'}):
             for x_val in product(*[(0, 1) for x in x_var]):
                 results = model.query(('Y',), intervention=dict(zip(x_var, x_val)))
@@ -7,18 +7,22 @@ from scm_mab.NIPS2018POMIS_exp.scm_examples import XYZWST_SCM, simple_markovian_
 from scm_mab.bandits import play_bandits
 from scm_mab.model import StructuralCausalModel
 from scm_mab.scm_bandits import SCM_to_bandit_machine, arms_of, arm_types
-from scm_mab.utils import subseq, mkdirs
+from scm_mab.utils import arm_dtype, subseq, mkdirs
 
 
-def main_experiment(M: StructuralCausalModel, Y="Y", num_trial=200, horizon=10000, n_jobs=1):
+def main_experiment(M: StructuralCausalModel, Y="Y", num_trial=200, horizon=10000, n_jobs=1, fast_forward=None):
+    """ fast_forward is the tolerance of Thompson Sampling's bulk simulation of converged trials (off by default) """
     results = dict()
     mu, arm_setting = SCM_to_bandit_machine(M)
     for arm_strategy in arm_types():
         arm_selected = arms_of(arm_strategy, arm_setting, M.G, Y)
-        arm_corrector = np.vectorize(lambda x: arm_selected[x])
+        arm_corrector = np.asarray(arm_selected, dtype=arm_dtype(len(mu)))
         for bandit_algo in ["TS", "UCB"]:
-            arm_played, rewards = play_bandits(horizon, subseq(mu, arm_selected), bandit_algo, num_trial, n_jobs)
-            results[(arm_strategy, bandit_algo)] = arm_corrector(arm_played), rewards
+            options = {"fast_forward": fast_forward} if bandit_algo == "TS" else dict()
+            arm_played, rewards = play_bandits(
+                horizon, subseq(mu, arm_selected), bandit_algo, num_trial, n_jobs, **options
+            )
+            results[(arm_strategy, bandit_algo)] = arm_corrector[arm_played], rewards
 
     return results, mu
 
@@ -33,9 +37,10 @@ def compute_arm_frequencies(arm_played, num_arms, horizon=None):
     return counts
 
 
-def compute_optimality(arm_played, mu):
-    mu_star = np.max(mu)
-    return np.vectorize(lambda x: int(mu[x] == mu_star))(arm_played)
+def compute_optimality(arm_played, mu) -> np.ndarray:
+    """ Integer matrix telling (one or zero) whether each arm played was an optimal one """
+    mu = np.asarray(mu)
+    return (mu[arm_played] == np.max(mu)).astype(int)
 
 
 def compute_cumulative_regret(rewards: np.ndarray, mu_star: float, remove_negative_cr: bool = False) -> np.ndarray:
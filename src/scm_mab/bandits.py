@@ -1,10 +1,25 @@
+import heapq
+import math
 import numpy as np
-from joblib import Parallel, delayed
-from numpy.random.mtrand import beta
+from collections import defaultdict
+from scipy.integrate import quad
 from scipy.optimize import brenth
-from typing import Tuple
-
-from scm_mab.utils import seeded, rand_argmax, with_default
+from scipy.special import betaln, xlogy
+from scipy.stats import beta as beta_dist
+from tqdm import tqdm
+from typing import Tuple, Union
+
+from scm_mab.history import BanditHistory, TrialAggregate
+from scm_mab.parallel import TrialPool, chunk_mu, get_trial_pool
+from scm_mab.utils import (
+    arm_dtype,
+    as_generator,
+    pick_randomly,
+    rand_argmax,
+    rand_argmax_rows,
+    spawn_seeds,
+    with_default,
+)
 
 
 def KL(mu_x, mu_star, epsilon=1e-12):
@@ -35,40 +50,76 @@ def sup_KL(mu_ref, divergence, lower=None):
     return brenth(lambda x: KL(mu_ref, x) - divergence, with_default(lower, mu_ref), 1)
 
 
-class U_keeper:
-    """  Keep look-ahead U values to save unnecessary computation (more effective if there is a large number of arms) """
-
-    def __init__(self, K_: int, T: int):
-        self.K_ = K_
-        self.T = T
-        self.lookahead_U = None
-        self.lookahead_t = None
-        self.step_sizes = None
-
-    def update_U(self, t, f, mu_hat, N, U, arm_x):
-        init_step_size = self.K_ * 2
-        T = self.T
-        K_ = self.K_
-        if t <= 5 * K_:
-            fval = f(t)
-            for i in range(K_):
-                U[i] = sup_KL(mu_hat[i], fval / N[i])
-            if t == 5 * K_:
-                ahead_t = min(t + init_step_size, T)
-                ft2 = f(ahead_t)
-                self.lookahead_U = np.array([sup_KL(mu_hat[i], ft2 / N[i]) for i in range(K_)])
-                self.lookahead_t = np.ones((len(mu_hat),)) * ahead_t
-        else:
-            fval = f(t)
-            threshold = U[arm_x] = sup_KL(mu_hat[arm_x], fval / N[arm_x])
+def KL_vec(mu_x, mu_star, epsilon=1e-12):
+    """ Elementwise KL, agrees with KL for 0 < mu_star < 1 """
+    return mu_x * np.log((mu_x + epsilon) / (mu_star + epsilon)) + (1 - mu_x) * np.log(
+        (1 - mu_x + epsilon) / (1 - mu_star + epsilon)
+    )
 
-            for arm in np.where(self.lookahead_U >= threshold)[0]:
-                if arm != arm_x:
-                    U[arm] = sup_KL(mu_hat[arm], fval / N[arm])
 
-            for arm in set(np.where(self.lookahead_t == t)[0]) | {arm_x}:
-                self.lookahead_t[arm] = ahead_t = t + init_step_size
-                self.lookahead_U[arm] = sup_KL(mu_hat[arm], f(ahead_t) / N[arm])
+def sup_KL_vec(mu_ref, divergence, xtol=2e-12, max_iter=100, epsilon=1e-12) -> np.ndarray:
+    """Elementwise sup_KL for arrays of any (broadcastable) shape, e.g. (K,) arms or (n_trials, K).
+
+    KL(mu_ref, .) is increasing and convex on [mu_ref, 1] so Newton steps started right of the root decrease
+    monotonically onto it. The start is the tighter of two upper bounds on the root, Pinsker's inequality for small
+    divergences and dropping the mu_ref * log(mu_ref / mu) term for large ones. Iterates are kept within [mu_ref, 1]
+    and stop at the same xtol as brenth in sup_KL.
+    """
+    mu_ref, divergence = np.broadcast_arrays(np.asarray(mu_ref, dtype=float), np.asarray(divergence, dtype=float))
+    U = np.where(mu_ref >= 1, 1.0, mu_ref)
+    todo = (divergence > 0) & (mu_ref < 1)
+    if not todo.any():
+        return U
+
+    p, d = mu_ref[todo], divergence[todo]
+    q = np.minimum(p + np.sqrt(d / 2), 1 - (1 - p) * np.exp((xlogy(p, p) - d) / (1 - p)))
+    # KL_vec(p, q) - d with the terms not depending on q hoisted out of the iterations
+    offset = p * np.log(p + epsilon) + (1 - p) * np.log(1 - p + epsilon) - d
+    with np.errstate(divide="ignore"):
+        for _ in range(max_iter):
+            q_eps, q_bar_eps = q + epsilon, 1 - q + epsilon
+            gap = offset - p * np.log(q_eps) - (1 - p) * np.log(q_bar_eps)
+            step = gap / ((1 - p) / q_bar_eps - p / q_eps)
+            q_new = np.minimum(np.maximum(q - step, p), 1)
+            converged = np.max(np.abs(q_new - q)) <= xtol
+            q = q_new
+            if converged:
+                break
+
+    U[todo] = q
+    return U
+
+
+def sup_KL_scalar(mu_ref: float, divergence: float, xtol=2e-12, max_iter=100, epsilon=1e-12) -> float:
+    """ sup_KL_vec of a single float by the same Newton steps, without the overhead of numpy calls """
+    p, d = mu_ref, divergence
+    if not d > 0 or p >= 1:
+        return min(p, 1.0)
+    q = min(p + math.sqrt(d / 2), 1 - (1 - p) * math.exp(((p * math.log(p) if p else 0.0) - d) / (1 - p)))
+    offset = p * math.log(p + epsilon) + (1 - p) * math.log(1 - p + epsilon) - d
+    for _ in range(max_iter):
+        q_eps, q_bar_eps = q + epsilon, 1 - q + epsilon
+        gap = offset - p * math.log(q_eps) - (1 - p) * math.log(q_bar_eps)
+        slope = (1 - p) / q_bar_eps - p / q_eps
+        q_new = min(max(q - gap / slope, p), 1.0) if slope > 0 else 1.0
+        converged = abs(q_new - q) <= xtol
+        q = q_new
+        if converged:
+            break
+    return q
+
+
+SCALAR_MAX_ARMS = 16  # below this, sup_KL_scalar per arm is faster than one sup_KL_vec call over all arms
+
+
+def kl_indices(mu_hat: np.ndarray, divergence: np.ndarray) -> np.ndarray:
+    """ sup_KL_vec of the (K,) empirical means and divergences of the arms, computed arm by arm if there are few """
+    if len(mu_hat) >= SCALAR_MAX_ARMS:
+        return sup_KL_vec(mu_hat, divergence)
+    return np.array([sup_KL_scalar(p, d) for p, d in zip(mu_hat.tolist(), divergence.tolist())])
+
+
+LAZY_MIN_ARMS = 1000  # below this, recomputing all indices with sup_KL_vec is faster
 
 
 def default_kl_UCB_func(t, value_at_small_t=1):
@@ -78,103 +129,724 @@ def default_kl_UCB_func(t, value_at_small_t=1):
         return np.log(t) + 3 * np.log(np.log(t))
 
 
-def kl_UCB(T: int, mu, f=None, seed=None, faster=True, prior_SF=None, **_kwargs):
-    """Bernoulli kl-UCB"""
+class LazyKLUCBIndex:
+    """Lazily maintained argmax of the kl-UCB indices, for a large number of arms.
+
+    Arms with the same number of pulls N and successes S share their index, and among arms with the same N the one with
+    the largest S has the largest index. Hence only the top state of each N can hold the maximum. Such a state's index
+    only grows with t until an arm moves in or out of it, so the index computed at a look-ahead time bounds it from
+    above until then. These bounds sit in a max-heap and every round only touches the states of the pulled arm, the
+    states whose look-ahead time has passed and the states whose bound exceeds the best exact index found so far.
+    Ties are broken uniformly at random over all arms, as in rand_argmax.
+    """
+
+    def __init__(self, N: np.ndarray, S: np.ndarray, f_table: np.ndarray, t: int, rng: np.random.Generator = None):
+        self.rng = rng
+        self.f_table = f_table  # f(t) for t = 0, ..., T
+        self.T = len(f_table) - 1
+        self.N, self.S = N.tolist(), S.tolist()
+        self.states = defaultdict(lambda: defaultdict(set))  # N -> S -> arms
+        for arm, (n, s) in enumerate(zip(self.N, self.S)):
+            self.states[n][s].add(arm)
+        self.heap = []
+        self.version = defaultdict(int)
+        self.expiry = defaultdict(list)
+        self.refresh(list(self.states), t)
+
+    def look_ahead(self, t: int) -> int:
+        return min(t + 1 + t // 8, self.T)
+
+    def refresh(self, Ns: list, t: int):
+        """ (Re)compute the bounds of the top states of given N so that they hold from round t until look-ahead """
+        Ns = [n for n in Ns if n in self.states]
+        if not Ns:
+            return
+        ahead_t = self.look_ahead(t)
+        N = np.array(Ns, dtype=float)
+        S = np.array([max(self.states[n]) for n in Ns], dtype=float)
+        bounds = sup_KL_vec(S / N, self.f_table[ahead_t] / N)
+        for n, s, bound in zip(Ns, S.tolist(), bounds.tolist()):
+            self.version[n] += 1
+            heapq.heappush(self.heap, (-bound, n, s, self.version[n]))
+            self.expiry[ahead_t].append((n, self.version[n]))
+
+        if len(self.heap) > 4 * len(self.states):
+            self.heap = [entry for entry in self.heap if entry[3] == self.version[entry[1]]]
+            heapq.heapify(self.heap)
+
+    def argmax(self, t: int) -> int:
+        self.refresh([n for n, version in self.expiry.pop(t - 1, ()) if version == self.version[n]], t)
+
+        # Pop states in batches, each holding every state whose bound reaches the best exact index seen so far
+        best, popped, candidates = -np.inf, [], []
+        while True:
+            batch = []
+            while self.heap:
+                neg_bound, n, s, version = self.heap[0]
+                if version != self.version[n]:
+                    heapq.heappop(self.heap)
+                elif -neg_bound >= best:
+                    batch.append(heapq.heappop(self.heap))
+                    if not popped and len(batch) == 1:
+                        break
+                else:
+                    break
+            if not batch:
+                break
+            N = np.array([entry[1] for entry in batch], dtype=float)
+            S = np.array([entry[2] for entry in batch])
+            exact = sup_KL_vec(S / N, self.f_table[t] / N)
+            best = max(best, exact.max())
+            candidates.extend(zip(exact.tolist(), batch))
+            popped.extend(batch)
+
+        for entry in popped:
+            heapq.heappush(self.heap, entry)
+        tied = [list(self.states[n][s]) for U, (_, n, s, _) in candidates if U == best]
+        return pick_randomly(tied[0] if len(tied) == 1 else sum(tied, []), self.rng)
+
+    def update(self, arm_x: int, reward_y, t: int):
+        """ Move the pulled arm to its new state, t being the next round """
+        n, s = self.N[arm_x], self.S[arm_x]
+        top_s = max(self.states[n])
+        self.states[n][s].remove(arm_x)
+        if not self.states[n][s]:
+            del self.states[n][s]
+            if not self.states[n]:
+                del self.states[n]
+
+        self.N[arm_x], self.S[arm_x] = n + 1, s + reward_y
+        is_new_top = n + 1 not in self.states or s + reward_y > max(self.states[n + 1])
+        self.states[n + 1][s + reward_y].add(arm_x)
+
+        changed = [n + 1] if is_new_top else []
+        if n in self.states and max(self.states[n]) != top_s:
+            changed.append(n)
+        elif n not in self.states:
+            self.version[n] += 1  # invalidates the heap entry of the gone state
+        self.refresh(changed, t)
+
+
+def kl_UCB(T: int, mu, f=None, seed=None, prior_SF=None, lazy=None, **_kwargs):
+    """Bernoulli kl-UCB
+
+    With lazy (by default when there are at least LAZY_MIN_ARMS arms) the best arm is tracked by LazyKLUCBIndex instead
+    of recomputing the indices of all arms every round.
+    """
     if f is None:
         f = default_kl_UCB_func
 
     K_ = len(mu)
-    faster = faster and K_ > 4
+    lazy = with_default(lazy, K_ >= LAZY_MIN_ARMS)
     N, mu_hat = np.zeros((K_,)), np.zeros((K_,))
     if prior_SF is not None:
-        S, F = prior_SF
-        for arm in range(K_):
-            N[arm] = S[arm] + F[arm]
-            mu_hat[arm] = S[arm] / (S[arm] + F[arm])
-
-    ukeeper = U_keeper(K_, T)
-
-    arms_selected = np.zeros((T,)).astype(int)
-    rewards = np.zeros((T,))
-    with seeded(seed):
-        rands = np.random.rand(T)
-        shuffled_arms = np.random.choice(K_, K_, replace=False)
-        for t, arm_x in enumerate(shuffled_arms):
-            reward_y = int(rands[t] <= mu[arm_x])
-            N[arm_x] += 1
-            mu_hat[arm_x] += (reward_y - mu_hat[arm_x]) / N[arm_x]
-
-            arms_selected[t] = arm_x
-            rewards[t] = reward_y
-
-        U = np.array([sup_KL(mu_hat[i], f(K_) / N[i]) for i in range(K_)])
-
-        # compute
-        for t in range(K_, T):
-            arm_x = rand_argmax(U)
-            # select
-            reward_y = int(rands[t] <= mu[arm_x])
-
-            arms_selected[t] = arm_x
-            rewards[t] = reward_y
-
-            # update for next
-            N[arm_x] += 1
-            mu_hat[arm_x] += (reward_y - mu_hat[arm_x]) / N[arm_x]
-
-            if not faster:
-                fval = f(t + 1)
-                U = np.array([sup_KL(mu_hat[i], fval / N[i]) for i in range(K_)])
-            else:
-                ukeeper.update_U(t + 1, f, mu_hat, N, U, arm_x)
+        S, F = np.asarray(prior_SF[0], dtype=float), np.asarray(prior_SF[1], dtype=float)
+        N = S + F
+        mu_hat = np.divide(S, N, out=np.zeros((K_,)), where=N > 0)
+
+    arms_selected = np.zeros((T,), dtype=arm_dtype(K_))
+    rewards = np.zeros((T,), dtype=np.uint8)
+    rng = as_generator(seed)
+    rands = rng.random(T)
+    shuffled_arms = rng.permutation(K_)
+    for t, arm_x in enumerate(shuffled_arms):
+        reward_y = int(rands[t] <= mu[arm_x])
+        N[arm_x] += 1
+        mu_hat[arm_x] += (reward_y - mu_hat[arm_x]) / N[arm_x]
+
+        arms_selected[t] = arm_x
+        rewards[t] = reward_y
+
+    if lazy:
+        index = LazyKLUCBIndex(N, mu_hat * N, np.array([f(t) for t in range(T + 1)]), K_, rng)
+    else:
+        U = kl_indices(mu_hat, f(K_) / N)
+
+    # compute
+    for t in range(K_, T):
+        arm_x = index.argmax(t) if lazy else rand_argmax(U, rng)
+        # select
+        reward_y = int(rands[t] <= mu[arm_x])
+
+        arms_selected[t] = arm_x
+        rewards[t] = reward_y
+
+        # update for next
+        N[arm_x] += 1
+        mu_hat[arm_x] += (reward_y - mu_hat[arm_x]) / N[arm_x]
+        if lazy:
+            index.update(arm_x, reward_y, t + 1)
+        else:
+            U = kl_indices(mu_hat, f(t + 1) / N)
+
+    return arms_selected, rewards
+
+
+def batched_kl_UCB(T: int, mu, n_trials: int, f=None, seed=None, prior_SF=None, **_kwargs):
+    """Bernoulli kl-UCB played in lockstep for all trials, see batched_thompson_sampling for the shape of mu"""
+    if f is None:
+        f = default_kl_UCB_func
+
+    mu = np.broadcast_to(np.asarray(mu, dtype=float), (n_trials, np.shape(mu)[-1]))
+    K_ = mu.shape[1]
+    N, mu_hat = np.zeros((n_trials, K_)), np.zeros((n_trials, K_))
+    if prior_SF is not None:
+        S, F = np.asarray(prior_SF[0], dtype=float), np.asarray(prior_SF[1], dtype=float)
+        N = N + S + F
+        mu_hat = mu_hat + np.divide(S, S + F, out=np.zeros(S.shape), where=(S + F) > 0)
+
+    trials = np.arange(n_trials)
+    arms_selected = np.zeros((n_trials, T), dtype=arm_dtype(K_))
+    rewards = np.zeros((n_trials, T), dtype=np.uint8)
+    rng = as_generator(seed)
+    # Every trial starts by playing each arm once, in its own random order
+    shuffled_arms = np.argsort(rng.random((n_trials, K_)), axis=1)
+    for t in range(T):
+        if t < K_:
+            arm_x = shuffled_arms[:, t]
+        else:
+            arm_x = rand_argmax_rows(sup_KL_vec(mu_hat, f(t) / N), rng)
+        reward_y = rng.random(n_trials) <= mu[trials, arm_x]
+
+        arms_selected[:, t] = arm_x
+        rewards[:, t] = reward_y
+
+        N[trials, arm_x] += 1
+        mu_hat[trials, arm_x] += (reward_y - mu_hat[trials, arm_x]) / N[trials, arm_x]
 
     return arms_selected, rewards
 
 
-def thompson_sampling(T: int, mu, seed=None, prior_SF=None, **_kwargs):
-    """Bernoulli Thompson Sampling with known mu"""
+FAST_FORWARD_EVERY = 100  # rounds between checks whether a Thompson Sampling trial can be fast-forwarded
+
+
+def prob_beta_greater(a1: float, b1: float, a2: float, b2: float) -> float:
+    """P(X1 > X2) for independent X1 ~ Beta(a1, b1) and X2 ~ Beta(a2, b2).
+
+    Exact finite sum over a1 terms if a1 is an integer, numerical integration otherwise (e.g. for fractional priors).
+    """
+    if float(a1).is_integer():
+        i = np.arange(int(a1))
+        return float(np.sum(np.exp(betaln(a2 + i, b1 + b2) - np.log(b1 + i) - betaln(1 + i, b1) - betaln(a2, b2))))
+    return quad(lambda x: beta_dist.pdf(x, a1, b1) * beta_dist.cdf(x, a2, b2), 0, 1)[0]
+
+
+def thompson_sampling(T: int, mu, seed=None, prior_SF=None, fast_forward: float = None, **_kwargs):
+    """Bernoulli Thompson Sampling with known mu
+
+    With a fast_forward tolerance, every FAST_FORWARD_EVERY rounds the leading arm a (by posterior mean) is checked for
+    dominance: the sum over the other arms j of P(theta_j > theta_a), exact under the current posteriors, bounds the
+    probability that a round does not play a. Once it is at most the tolerance the posteriors are frozen and the
+    remaining rounds are drawn in bulk: arms are allocated by a multinomial draw with these probabilities (a taking the
+    rest) and shuffled into rounds, and their rewards come from the same uniform numbers as round-by-round play, so the
+    history is a consistent per-round one. Freezing only overstates the plays of other arms (their posteriors would
+    keep concentrating), by at most the tolerance per remaining round in expectation.
+    """
     K_ = len(mu)
     S, F, theta = np.zeros((K_,)), np.zeros((K_,)), np.zeros((K_,))
     if prior_SF is not None:
-        S, F = prior_SF
+        # copies, the prior is shared by all trials
+        S, F = np.array(prior_SF[0], dtype=float), np.array(prior_SF[1], dtype=float)
+
+    arms_selected = np.zeros((T,), dtype=arm_dtype(K_))
+    rewards = np.zeros((T,), dtype=np.uint8)
+    rng = as_generator(seed)
+    random_numbers = rng.random(T)
+
+    for t in range(T):
+        if fast_forward is not None and t and t % FAST_FORWARD_EVERY == 0:
+            leader = np.argmax((S + 1) / (S + F + 2))
+            p_other = np.zeros((K_,))
+            for j in range(K_):
+                if j != leader:
+                    p_other[j] = prob_beta_greater(S[j] + 1, F[j] + 1, S[leader] + 1, F[leader] + 1)
+            if p_other.sum() <= fast_forward:
+                p_other[leader] = 1 - p_other.sum()
+                counts = rng.multinomial(T - t, p_other)
+                arms_selected[t:] = rng.permutation(np.repeat(np.arange(K_), counts))
+                rewards[t:] = random_numbers[t:] <= np.asarray(mu)[arms_selected[t:]]
+                break
+
+        # Conjugate prior to Bernoulli random variable
+        theta = rng.beta(S + 1, F + 1)
+        arm_x = rand_argmax(theta, rng)
+        reward_y = int(random_numbers[t] <= mu[arm_x])
+
+        arms_selected[t] = arm_x
+        rewards[t] = reward_y
+
+        if reward_y == 1:
+            # Success
+            S[arm_x] += 1
+        else:
+            # Failure
+            F[arm_x] += 1
 
-    arms_selected = np.zeros((T,)).astype(int)
-    rewards = np.zeros((T,))
-    with seeded(seed):
-        random_numbers = np.random.rand(T)
+    return arms_selected, rewards
 
-        for t in range(T):
-            # Conjugate prior to Bernoulli random variable
-            theta = [beta(S[i] + 1, F[i] + 1) for i in range(K_)]
-            arm_x = rand_argmax(theta)
-            reward_y = int(random_numbers[t] <= mu[arm_x])
 
-            arms_selected[t] = arm_x
-            rewards[t] = reward_y
+def batched_thompson_sampling(T: int, mu, n_trials: int, seed=None, prior_SF=None, **_kwargs):
+    """Bernoulli Thompson Sampling with known mu, played in lockstep for all trials.
 
-            if reward_y == 1:
-                # Success
-                S[arm_x] += 1
-            else:
-                # Failure
-                F[arm_x] += 1
+    The posterior of every trial is kept as one (n_trials, K) state so that each round costs a single vectorized beta
+    draw. mu is either shared by all trials, shape (K,), or given per trial, shape (n_trials, K).
+    """
+    mu = np.broadcast_to(np.asarray(mu, dtype=float), (n_trials, np.shape(mu)[-1]))
+    K_ = mu.shape[1]
+    S, F = np.zeros((n_trials, K_)), np.zeros((n_trials, K_))
+    if prior_SF is not None:
+        S, F = S + prior_SF[0], F + prior_SF[1]
+
+    trials = np.arange(n_trials)
+    arms_selected = np.zeros((n_trials, T), dtype=arm_dtype(K_))
+    rewards = np.zeros((n_trials, T), dtype=np.uint8)
+    rng = as_generator(seed)
+    for t in range(T):
+        # Conjugate prior to Bernoulli random variable, drawn for all trials and arms at once
+        theta = rng.beta(S + 1, F + 1)
+        arm_x = rand_argmax_rows(theta, rng)
+        reward_y = rng.random(n_trials) <= mu[trials, arm_x]
+
+        arms_selected[:, t] = arm_x
+        rewards[:, t] = reward_y
+
+        S[trials, arm_x] += reward_y
+        F[trials, arm_x] += ~reward_y
 
     return arms_selected, rewards
 
 
-def play_bandits(T: int, mu, algo: str, n_trials: int, n_jobs=1) -> Tuple[np.ndarray, np.ndarray]:
-    if algo == "TS":
-        par_result = Parallel(n_jobs=n_jobs, verbose=100)(
-            delayed(thompson_sampling)(T, mu, seed=trial) for trial in range(n_trials)
-        )
-    elif algo == "UCB":
-        par_result = Parallel(n_jobs=n_jobs, verbose=100)(
-            delayed(kl_UCB)(T, mu, seed=trial) for trial in range(n_trials)
+DEFAULT_WINDOW = 1000  # rounds remembered by sliding-window Thompson Sampling
+DEFAULT_GAMMA = 0.999  # discount per round of discounted kl-UCB
+
+
+def sliding_window_thompson_sampling(T: int, mu, seed=None, prior_SF=None, window=DEFAULT_WINDOW, **_kwargs):
+    """Bernoulli Thompson Sampling whose posterior only counts the last window rounds (on top of the prior).
+
+    Every round adds its outcome to S, F and evicts that of round t - window in O(1), kept in a ring buffer of the last
+    window outcomes, so that the state of the algorithm takes O(window) memory (the history returned is O(T)).
+    """
+    K_ = len(mu)
+    S, F = np.zeros((K_,)), np.zeros((K_,))
+    if prior_SF is not None:
+        S, F = np.array(prior_SF[0], dtype=float), np.array(prior_SF[1], dtype=float)
+
+    arms_selected = np.zeros((T,), dtype=arm_dtype(K_))
+    rewards = np.zeros((T,), dtype=np.uint8)
+    rng = as_generator(seed)
+    random_numbers = rng.random(T)
+    # outcome of round t at t % window, for the window rounds before the current one
+    window_arms, window_rewards = np.zeros((min(window, T),), dtype=int), np.zeros((min(window, T),), dtype=int)
+
+    for t in range(T):
+        theta = rng.beta(S + 1, F + 1)
+        arm_x = rand_argmax(theta, rng)
+        reward_y = int(random_numbers[t] <= mu[arm_x])
+
+        arms_selected[t] = arm_x
+        rewards[t] = reward_y
+
+        S[arm_x] += reward_y
+        F[arm_x] += 1 - reward_y
+        slot = t % window
+        if t >= window:
+            old_arm, old_reward = window_arms[slot], window_rewards[slot]
+            S[old_arm] -= old_reward
+            F[old_arm] -= 1 - old_reward
+        window_arms[slot], window_rewards[slot] = arm_x, reward_y
+
+    return arms_selected, rewards
+
+
+def batched_sliding_window_thompson_sampling(
+    T: int, mu, n_trials: int, seed=None, prior_SF=None, window=DEFAULT_WINDOW, **_kwargs
+):
+    """sliding_window_thompson_sampling played in lockstep for all trials, see batched_thompson_sampling, with a ring
+    buffer of the last window outcomes of every trial"""
+    mu = np.broadcast_to(np.asarray(mu, dtype=float), (n_trials, np.shape(mu)[-1]))
+    K_ = mu.shape[1]
+    S, F = np.zeros((n_trials, K_)), np.zeros((n_trials, K_))
+    if prior_SF is not None:
+        S, F = S + prior_SF[0], F + prior_SF[1]
+
+    trials = np.arange(n_trials)
+    arms_selected = np.zeros((n_trials, T), dtype=arm_dtype(K_))
+    rewards = np.zeros((n_trials, T), dtype=np.uint8)
+    rng = as_generator(seed)
+    window_arms = np.zeros((n_trials, min(window, T)), dtype=int)
+    window_rewards = np.zeros((n_trials, min(window, T)), dtype=bool)
+    for t in range(T):
+        theta = rng.beta(S + 1, F + 1)
+        arm_x = rand_argmax_rows(theta, rng)
+        reward_y = rng.random(n_trials) <= mu[trials, arm_x]
+
+        arms_selected[:, t] = arm_x
+        rewards[:, t] = reward_y
+
+        S[trials, arm_x] += reward_y
+        F[trials, arm_x] += ~reward_y
+        slot = t % window
+        if t >= window:
+            old_arm, old_reward = window_arms[:, slot], window_rewards[:, slot]
+            S[trials, old_arm] -= old_reward
+            F[trials, old_arm] -= ~old_reward
+        window_arms[:, slot], window_rewards[:, slot] = arm_x, reward_y
+
+    return arms_selected, rewards
+
+
+def discounted_kl_UCB(T: int, mu, f=None, seed=None, prior_SF=None, gamma=DEFAULT_GAMMA, **_kwargs):
+    """Bernoulli kl-UCB on exponentially discounted counts of pulls and successes (D-UCB with a KL index).
+
+    Every round all counts decay by gamma before the pulled arm's are incremented, and the exploration term uses the
+    discounted number of rounds. Arms without any (discounted) pull have an index of one, so no initial round robin.
+    """
+    if f is None:
+        f = default_kl_UCB_func
+
+    K_ = len(mu)
+    N, S = np.zeros((K_,)), np.zeros((K_,))
+    if prior_SF is not None:
+        S = np.array(prior_SF[0], dtype=float)
+        N = S + prior_SF[1]
+    n_eff = N.sum()  # discounted number of rounds, the same in every trial
+
+    arms_selected = np.zeros((T,), dtype=arm_dtype(K_))
+    rewards = np.zeros((T,), dtype=np.uint8)
+    rng = as_generator(seed)
+    rands = rng.random(T)
+    for t in range(T):
+        pulled = N > 0
+        U = np.ones((K_,))
+        U[pulled] = kl_indices(S[pulled] / N[pulled], f(n_eff) / N[pulled])
+        arm_x = rand_argmax(U, rng)
+        reward_y = int(rands[t] <= mu[arm_x])
+
+        arms_selected[t] = arm_x
+        rewards[t] = reward_y
+
+        N *= gamma
+        S *= gamma
+        N[arm_x] += 1
+        S[arm_x] += reward_y
+        n_eff = gamma * n_eff + 1
+
+    return arms_selected, rewards
+
+
+def batched_discounted_kl_UCB(
+    T: int, mu, n_trials: int, f=None, seed=None, prior_SF=None, gamma=DEFAULT_GAMMA, **_kwargs
+):
+    """discounted_kl_UCB played in lockstep for all trials, see batched_thompson_sampling for the shape of mu"""
+    if f is None:
+        f = default_kl_UCB_func
+
+    mu = np.broadcast_to(np.asarray(mu, dtype=float), (n_trials, np.shape(mu)[-1]))
+    K_ = mu.shape[1]
+    N, S = np.zeros((n_trials, K_)), np.zeros((n_trials, K_))
+    if prior_SF is not None:
+        S = S + prior_SF[0]
+        N = S + prior_SF[1]
+    n_eff = N[0].sum() if n_trials else 0.0
+
+    trials = np.arange(n_trials)
+    arms_selected = np.zeros((n_trials, T), dtype=arm_dtype(K_))
+    rewards = np.zeros((n_trials, T), dtype=np.uint8)
+    rng = as_generator(seed)
+    for t in range(T):
+        pulled = N > 0
+        mu_hat = np.divide(S, N, out=np.zeros(N.shape), where=pulled)
+        divergence = np.divide(f(n_eff), N, out=np.full(N.shape, np.inf), where=pulled)
+        arm_x = rand_argmax_rows(np.where(pulled, sup_KL_vec(mu_hat, divergence), 1.0), rng)
+        reward_y = rng.random(n_trials) <= mu[trials, arm_x]
+
+        arms_selected[:, t] = arm_x
+        rewards[:, t] = reward_y
+
+        N *= gamma
+        S *= gamma
+        N[trials, arm_x] += 1
+        S[trials, arm_x] += reward_y
+        n_eff = gamma * n_eff + 1
+
+    return arms_selected, rewards
+
+
+IDENTIFICATION_SLACK = 0.1  # the arms identified are within this of the best arm, so that tied arms stop
+IDENTIFICATION_CHECK_EVERY = 10  # rounds between two tests of the stopping rule
+
+
+def kl_LUCB_bounds(S: np.ndarray, N: np.ndarray, t: int, confidence: float, slack=0.0) -> Tuple[np.ndarray, ...]:
+    """KL-LUCB stopping rule, row-wise for (n_trials, K) counts of successes S and pulls N (all positive).
+
+    A row stops once the KL lower confidence bound of its empirical best arm, plus slack, exceeds the upper bounds of
+    all other arms, with the exploration rate log(K (1 + log t) / confidence) used in practice for KL-LUCB. Returns
+    whether each row stops, its empirical best arm and its challenger, the other arm with the largest upper bound.
+    """
+    mu_hat = S / N
+    rows = np.arange(len(N))
+    best = np.argmax(mu_hat, axis=1)
+    beta = np.log(N.shape[1] * (1 + np.log(max(t, 1))) / confidence)
+    ucb = sup_KL_vec(mu_hat, beta / N)
+    ucb[rows, best] = -np.inf
+    challenger = np.argmax(ucb, axis=1)
+    best_lcb = 1 - sup_KL_vec(1 - mu_hat[rows, best], beta / N[rows, best])
+    return best_lcb + slack > ucb[rows, challenger], best, challenger
+
+
+def identify_best_arm(
+    T: int,
+    mu,
+    algo="TS",
+    confidence=0.05,
+    seed=None,
+    prior_SF=None,
+    slack=IDENTIFICATION_SLACK,
+    check_every=IDENTIFICATION_CHECK_EVERY,
+    **_kwargs,
+) -> Tuple[int, int]:
+    """Fixed-confidence best arm identification which stops as soon as kl_LUCB_bounds does (or after T rounds), the
+    arm identified being within slack of the best one with probability 1 - confidence.
+
+    The stopping rule is tested every check_every rounds, which bounds its cost, once every arm was pulled. Until then
+    each round pulls an arm never pulled. "UCB" then alternates between the empirical best arm and the challenger of
+    the last test (KL-LUCB), while "TS" plays top-two Thompson sampling, i.e. the arm with the largest posterior draw
+    or, with probability one half, the best arm of a second draw among the others. Returns the identified arm (the
+    empirical best if the budget runs out) and the number of rounds played.
+
+    prior_SF pseudo-counts seed the successes and failures from which both the posterior draws and the KL-LUCB bounds
+    are computed, so that arms with pseudo-counts are not pulled first and a confident prior stops trials earlier.
+    """
+    check_identification_algorithm(algo)
+    K_ = len(mu)
+    S, F = np.zeros((1, K_)), np.zeros((1, K_))
+    if prior_SF is not None:
+        S, F = S + prior_SF[0], F + prior_SF[1]
+
+    rng = as_generator(seed)
+    rands = rng.random(T)
+    pair = None  # empirical best arm and challenger of the last test
+    for t in range(T):
+        N = S + F
+        if pair is None and not N.all():
+            arm_x = pick_randomly(np.flatnonzero(N[0] == 0), rng)
+        else:
+            if pair is None or t % check_every == 0:
+                stop, best, challenger = kl_LUCB_bounds(S, N, t, confidence, slack)
+                if stop[0]:
+                    return best[0], t
+                pair = best[0], challenger[0]
+            if algo == "UCB":
+                arm_x = pair[t % 2]
+            else:
+                # posterior draws are continuous, hence never tied
+                theta = rng.beta(S[0] + 1, F[0] + 1)
+                arm_x = int(np.argmax(theta))
+                if rng.random() < 0.5:
+                    theta = rng.beta(S[0] + 1, F[0] + 1)
+                    theta[arm_x] = -np.inf
+                    arm_x = int(np.argmax(theta))
+        reward_y = int(rands[t] <= mu[arm_x])
+        S[0, arm_x] += reward_y
+        F[0, arm_x] += 1 - reward_y
+
+    N = S[0] + F[0]
+    return rand_argmax(np.divide(S[0], N, out=np.zeros((K_,)), where=N > 0), rng), T
+
+
+def batched_identify_best_arm(
+    T: int,
+    mu,
+    n_trials: int,
+    algo="TS",
+    confidence=0.05,
+    seed=None,
+    prior_SF=None,
+    slack=IDENTIFICATION_SLACK,
+    check_every=IDENTIFICATION_CHECK_EVERY,
+    **_kwargs,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """identify_best_arm played in lockstep for all trials, see batched_thompson_sampling for the shape of mu.
+
+    Trials which have stopped are dropped from the state so that later rounds only cost as much as the trials still
+    running. Returns the identified arms and the stopping times, both of shape (n_trials,).
+    """
+    check_identification_algorithm(algo)
+    mu = np.broadcast_to(np.asarray(mu, dtype=float), (n_trials, np.shape(mu)[-1]))
+    K_ = mu.shape[1]
+    S, F = np.zeros((n_trials, K_)), np.zeros((n_trials, K_))
+    if prior_SF is not None:
+        S, F = S + prior_SF[0], F + prior_SF[1]
+
+    identified = np.zeros((n_trials,), dtype=arm_dtype(K_))
+    stopping_times = np.full((n_trials,), T)
+    running = np.arange(n_trials)  # trial of each row of the state
+    # empirical best arm and challenger of the last test of each row, and whether it was tested yet
+    best, challenger = np.zeros((n_trials,), dtype=int), np.zeros((n_trials,), dtype=int)
+    tested = np.zeros((n_trials,), dtype=bool)
+    rng = as_generator(seed)
+    for t in range(T):
+        N = S + F
+        ready = tested | N.all(axis=1)
+        # trials with an arm never pulled pull one of those at random
+        arm_x = rand_argmax_rows(N == 0, rng)
+        stop = np.zeros((len(running),), dtype=bool)
+        test = ready & (~tested | (t % check_every == 0))
+        if test.any():
+            stop[test], best[test], challenger[test] = kl_LUCB_bounds(S[test], N[test], t, confidence, slack)
+            tested |= test
+            identified[running[stop]] = best[stop]
+            stopping_times[running[stop]] = t
+        if ready.any():
+            if algo == "UCB":
+                arm_x[ready] = (best if t % 2 == 0 else challenger)[ready]
+            else:
+                theta = rng.beta(S[ready] + 1, F[ready] + 1)
+                leader = np.argmax(theta, axis=1)
+                theta = rng.beta(S[ready] + 1, F[ready] + 1)
+                theta[np.arange(len(leader)), leader] = -np.inf
+                arm_x[ready] = np.where(rng.random(len(leader)) < 0.5, np.argmax(theta, axis=1), leader)
+        if stop.any():
+            S, F, running, arm_x = S[~stop], F[~stop], running[~stop], arm_x[~stop]
+            best, challenger, tested = best[~stop], challenger[~stop], tested[~stop]
+        if not len(running):
+            break
+
+        rows = np.arange(len(running))
+        reward_y = rng.random(len(running)) <= mu[running, arm_x]
+        S[rows, arm_x] += reward_y
+        F[rows, arm_x] += ~reward_y
+
+    if len(running):
+        N = S + F
+        identified[running] = rand_argmax_rows(np.divide(S, N, out=np.zeros(N.shape), where=N > 0), rng)
+    return identified, stopping_times
+
+
+def bandit_algorithms():
+    return ["TS", "UCB", "SW-TS", "D-UCB"]
+
+
+def identification_algorithms():
+    """ The algorithms of identify_best_arm, whose stopping rule assumes stationary rewards (unlike SW-TS and D-UCB) """
+    return ["TS", "UCB"]
+
+
+def check_identification_algorithm(algo: str):
+    """ Raise a ValueError unless best arm identification (a confidence) can be played with algo """
+    if algo not in identification_algorithms():
+        raise ValueError(
+            f"best arm identification (with a confidence) supports {identification_algorithms()}, not {algo}: its "
+            "KL-LUCB stopping rule assumes stationary rewards, which sliding windows and discounts do not"
         )
-    else:
-        raise AssertionError(f"unknown algo: {algo}")
 
-    return (
-        np.vstack(tuple(arms_selected for arms_selected, _ in par_result)),
-        np.vstack(tuple(rewards for _, rewards in par_result)),
-    )
+
+_algorithms = {
+    "TS": thompson_sampling,
+    "UCB": kl_UCB,
+    "SW-TS": sliding_window_thompson_sampling,
+    "D-UCB": discounted_kl_UCB,
+}
+_batched_algorithms = {
+    "TS": batched_thompson_sampling,
+    "UCB": batched_kl_UCB,
+    "SW-TS": batched_sliding_window_thompson_sampling,
+    "D-UCB": batched_discounted_kl_UCB,
+}
+
+
+AGGREGATE_BLOCK = 256  # trials per batched engine call when aggregating
+
+
+def play_bandits(
+    T: int,
+    mu,
+    algo: str,
+    n_trials: int,
+    n_jobs=1,
+    batched=False,
+    seed=0,
+    backend="loky",
+    pool: TrialPool = None,
+    aggregate=False,
+    mu_star: float = None,
+    prior_SF: Tuple[np.ndarray, np.ndarray] = None,
+    confidence: float = None,
+    compact=False,
+    run_length=False,
+    progress=False,
+    **algo_kwargs,
+) -> Union[Tuple[np.ndarray, np.ndarray], BanditHistory, TrialAggregate]:
+    """Play n_trials independent bandits with T rounds each.
+
+    With batched=True all trials are advanced together in this process (n_jobs is ignored), otherwise trials are played
+    in chunks by a TrialPool, by default the long-lived pool shared by all calls with the same n_jobs, backend and
+    progress (whether to show a progress bar updated once per chunk, or per block of batched aggregated trials).
+    Trial i draws from the i-th child stream spawned from the root seed, so results do not depend on the number of
+    workers, the backend or the order in which trials are scheduled. Since no global random state is touched, the
+    "threading" backend is safe to use as well.
+
+    With aggregate=True the (n_trials, T) arrays are never materialized: trials are folded into a TrialAggregate (whose
+    optimal reward is mu_star, max(mu) by default) as they are played, whose results have the keys of get_results but
+    means over trials in place of the (n_trials, T) matrices. Batched engines then advance AGGREGATE_BLOCK trials at a
+    time, block b drawing from the b-th child stream of the root seed.
+
+    With compact=True the (n_trials, T) arrays are returned as a BanditHistory (which still unpacks into them), with
+    bit-packed rewards and, with run_length=True, run-length encoded arms.
+
+    prior_SF, pseudo-counts of successes and failures per arm (which may be fractional), warm-starts every trial.
+    Remaining keyword arguments go to the algorithm, e.g. window for "SW-TS", gamma for "D-UCB" or fast_forward for
+    "TS" (when not batched).
+
+    With a confidence (the tolerated probability of error) every trial rather stops as soon as it has identified the
+    best arm, see identify_best_arm (whose bounds prior_SF seeds), and the identified arms and stopping times of the
+    trials are returned, both of shape (n_trials,). T is then the budget of rounds per trial, and slack (how far from
+    the best arm the identified one may be) and check_every keyword arguments go to identify_best_arm.
+    """
+    if algo not in bandit_algorithms():
+        raise AssertionError(f"unknown algo: {algo}")
+    if algo_kwargs.get("fast_forward") is not None and (algo != "TS" or batched or confidence is not None):
+        raise ValueError(
+            "fast_forward only applies to Thompson Sampling played trial by trial (algo='TS', batched=False and no "
+            "confidence), the other engines would ignore it"
+        )
+    algo_kwargs["prior_SF"] = prior_SF
+
+    if confidence is not None:
+        check_identification_algorithm(algo)
+        assert not aggregate, "best arm identification keeps one arm and stopping time per trial only"
+        if batched:
+            return batched_identify_best_arm(T, mu, n_trials, algo, confidence, seed=seed, **algo_kwargs)
+        pool = with_default(pool, get_trial_pool(n_jobs, backend, progress))
+        out = pool.allocate((n_trials,), arm_dtype(np.shape(mu)[-1])), pool.allocate((n_trials,), np.int64)
+        seeds = spawn_seeds(seed, n_trials)
+        return pool.play(identify_best_arm, T, mu, seeds, out=out, algo=algo, confidence=confidence, **algo_kwargs)
+
+    if batched:
+        engine = _batched_algorithms[algo]
+        if not aggregate:
+            return histories(engine(T, mu, n_trials, seed=seed, **algo_kwargs), mu, compact, run_length)
+
+        summary = TrialAggregate(T, mu, mu_star)
+        starts = range(0, n_trials, AGGREGATE_BLOCK)
+        blocks = zip(starts, spawn_seeds(seed, len(starts)))
+        for start, block_seed in tqdm(blocks, total=len(starts), desc="Trial blocks", disable=not progress):
+            stop = min(start + AGGREGATE_BLOCK, n_trials)
+            block_mu = chunk_mu(mu, start, stop)
+            summary.add(*engine(T, block_mu, stop - start, seed=block_seed, **algo_kwargs), mu=block_mu)
+        return summary
+
+    algorithm = _algorithms[algo]
+    pool = with_default(pool, get_trial_pool(n_jobs, backend, progress))
+    if aggregate:
+        return pool.aggregate(algorithm, T, mu, spawn_seeds(seed, n_trials), mu_star, **algo_kwargs)
+    return histories(pool.play(algorithm, T, mu, spawn_seeds(seed, n_trials), **algo_kwargs), mu, compact, run_length)
+
+
+def histories(
+    arrays: Tuple[np.ndarray, np.ndarray], mu, compact=False, run_length=False
+) -> Union[Tuple[np.ndarray, np.ndarray], BanditHistory]:
+    """ The (arms_selected, rewards) of play_bandits, as a BanditHistory if compact """
+    if not compact:
+        return arrays
+    return BanditHistory(*arrays, n_arms=np.shape(mu)[-1], run_length=run_length)
@@ -0,0 +1,110 @@
+import numpy as np
+import weakref
+from collections import OrderedDict
+from itertools import product
+from typing import Callable, Dict, Sequence
+
+from scm_mab.inference import enumerate_U, equation_inputs, evaluate
+
+""" Structural equations compiled into lookup tables over the domains of their inputs """
+
+COMPILE_LIMIT = 1 << 16  # largest table, equations with more input configurations are left as they are
+
+_compiled = weakref.WeakKeyDictionary()  # SEM -> {(time-slice, G, U, domains): compiled equations}
+
+
+class CompiledEquation:
+    """
+    Structural equation evaluated once on every configuration of its inputs, then looked up.
+
+    Arrays of inputs are looked up by fancy indexing into the table and single values in a dictionary, values outside
+    of the domains compiled for are handed to the original equation.
+
+    Parameters
+    ----------
+    f : Callable
+        Original structural equation
+    inputs : Sequence[str]
+        Variables f depends on
+    domains : Sequence
+        Domain of each input, in the order of the axes of table
+    table : np.ndarray
+        Value of f for each configuration of the inputs, one axis per input
+    """
+
+    def __init__(self, f: Callable, inputs: Sequence[str], domains: Sequence, table: np.ndarray):
+        self.f = f
+        self.inputs = tuple(inputs)
+        self.domains = [np.asarray(domain) for domain in domains]
+        self.table = table
+        self._orders = [np.argsort(domain) for domain in self.domains]
+        self._sorted = [domain[order] for domain, order in zip(self.domains, self._orders)]
+        self._lookup = None
+
+    def __call__(self, v):
+        values = [np.asarray(v[name]) for name in self.inputs]
+        if all(value.ndim == 0 for value in values):
+            if self._lookup is None:
+                configurations = product(*[domain.tolist() for domain in self.domains])
+                self._lookup = dict(zip(configurations, np.ravel(self.table).tolist()))
+            key = tuple(value.item() for value in values)
+            return self._lookup[key] if key in self._lookup else self.f(v)
+
+        index = []
+        for value, sorted_domain, order in zip(values, self._sorted, self._orders):
+            position = np.searchsorted(sorted_domain, value).clip(max=len(sorted_domain) - 1)
+            if not np.all(sorted_domain[position] == value):
+                return self.f(v)
+            index.append(order[position])
+        return self.table[tuple(index)]
+
+
+def compile_equations(F: dict, G, U: Sequence[str], D) -> Dict[str, Callable]:
+    """F with the equation of every variable compiled into a CompiledEquation, in the order of F.
+
+    Equations are compiled in causal order, the domain of a variable being the values its table takes. Equations are
+    left as they are if they fail on arrays of inputs, if the table would exceed COMPILE_LIMIT entries or if they depend
+    on a variable which could not be compiled (whose domain is then unknown).
+    """
+    domains = {U_i: np.asarray(D[U_i]) for U_i in U}
+    compiled = dict()
+    for V_i in G.causal_order():
+        if V_i not in F:
+            continue
+        inputs = sorted(equation_inputs(F, G, V_i, U, D))
+        if not all(name in domains for name in inputs):
+            continue
+        n = int(np.prod([len(domains[name]) for name in inputs]))
+        if n > COMPILE_LIMIT:
+            continue
+        try:
+            values = evaluate(F[V_i], enumerate_U(inputs, domains, 0, n), n)
+        except Exception:
+            continue
+        domains[V_i] = np.unique(values)
+        table = values.reshape([len(domains[name]) for name in inputs])
+        compiled[V_i] = CompiledEquation(F[V_i], inputs, [domains[name] for name in inputs], table)
+    return OrderedDict((V_i, compiled.get(V_i, f)) for V_i, f in F.items())
+
+
+def compiled_equations(SEM, G, U: Sequence[str], D, past_assigned: dict = None, cache: dict = None) -> dict:
+    """The compiled static equations of SEM (a SEM class or a dict of equations), or its dynamic ones given the values
+    past_assigned of the previous time-slice.
+
+    Compiled equations are cached per SEM object, so that models sharing a SEM share them, or in cache if the SEM cannot
+    be weakly referenced (e.g. a dict).
+    """
+    try:
+        cache = _compiled.setdefault(SEM, dict())
+    except TypeError:
+        cache = cache if cache is not None else dict()
+    past = None if past_assigned is None else tuple(sorted(past_assigned.items()))
+    key = past, G, tuple(U), tuple(tuple(D[U_i]) for U_i in U)
+    if key not in cache:
+        if past_assigned is None:
+            F = SEM.static() if hasattr(SEM, "static") else SEM
+        else:
+            F = SEM.dynamic(past_assigned)
+        cache[key] = compile_equations(F, G, U, D)
+    return cache[key]
+
@@ -0,0 +1,117 @@
+import numpy as np
+from itertools import product
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from scm_mab.inference import ancestral_closure, enumerate_U, equation_inputs, evaluate, marginal_probabilities
+
+""" Exact inference on structural causal models by variable elimination over their factor graph """
+
+Factor = Tuple[Tuple[str, ...], np.ndarray]  # scope and table, with one axis per variable of the scope
+
+
+def multiply_out(factors: Sequence[Factor], keep: Sequence[str]) -> Factor:
+    """ The product of factors, summed over every variable of their scopes which is not kept """
+    names = sorted({name for scope, _ in factors for name in scope})
+    ids = {name: i for i, name in enumerate(names)}  # einsum takes at most 52 subscripts per call
+    kept = tuple(name for name in names if name in keep)
+    operands = []
+    for scope, table in factors:
+        operands += [table, [ids[name] for name in scope]]
+    return kept, np.einsum(*operands, [ids[name] for name in kept], optimize=len(factors) > 2)
+
+
+def min_fill_order(factors: Sequence[Factor], to_eliminate: Sequence[str], cards: Dict[str, int]) -> List[str]:
+    """Greedy elimination order: fewest fill-in edges first, then the smallest product of neighbour cardinalities,
+    then the name, so that the order is deterministic"""
+    neighbours = {name: set() for scope, _ in factors for name in scope}
+    for scope, _ in factors:
+        for name in scope:
+            neighbours[name] |= set(scope) - {name}
+
+    def cost(name):
+        nbs = sorted(neighbours[name])
+        fill = sum(1 for i, a in enumerate(nbs) for b in nbs[i + 1 :] if b not in neighbours[a])
+        return fill, int(np.prod([cards[nb] for nb in nbs])), name
+
+    order, remaining = [], set(to_eliminate)
+    while remaining:
+        name = min(remaining, key=cost)
+        for a in neighbours[name]:
+            neighbours[a] |= neighbours[name] - {a}
+            neighbours[a].discard(name)
+        del neighbours[name]
+        remaining.remove(name)
+        order.append(name)
+    return order
+
+
+def eliminate(factors: List[Factor], to_eliminate: Sequence[str], cards: Dict[str, int]) -> List[Factor]:
+    """ Sum the variables to_eliminate out of the product of factors, one at a time in min_fill_order """
+    for name in min_fill_order(factors, to_eliminate, cards):
+        involved = [factor for factor in factors if name in factor[0]]
+        factors = [factor for factor in factors if name not in factor[0]]
+        scope = {other for other_scope, _ in involved for other in other_scope} - {name}
+        factors.append(multiply_out(involved, scope))
+    return factors
+
+
+def compile_factors(
+    F: dict, G, V_ordered: Sequence[str], U: Sequence[str], D, P_U: Callable, intervention: dict
+) -> Tuple[List[Factor], Dict[str, np.ndarray]]:
+    """Factors of the SCM restricted to V_ordered and U, and the domain of every variable.
+
+    Each background variable gets its prior (or all of U one joint prior if P_U is not of product form) and each
+    endogenous variable a deterministic CPT over the inputs of its equation, a point mass if it is intervened on.
+    Domains of endogenous variables are the values their equations actually take, so that they are found in causal
+    order.
+    """
+    domains = {U_i: np.asarray(D[U_i]) for U_i in U}
+    factors = []
+    marginals = marginal_probabilities(P_U, U, D)
+    if marginals is not None:
+        factors += [((U_i,), marginal) for U_i, marginal in zip(U, marginals)]
+    elif U:
+        joint = np.array([P_U(dict(zip(U, u))) for u in product(*[D[U_i] for U_i in U])], dtype=float)
+        factors.append((tuple(U), joint.reshape([len(domains[U_i]) for U_i in U])))
+
+    for V_i in V_ordered:
+        if V_i in intervention:
+            domains[V_i] = np.asarray([intervention[V_i]])
+            factors.append(((V_i,), np.ones((1,))))
+            continue
+        inputs = sorted(equation_inputs(F, G, V_i, U, D) & (set(V_ordered) | set(U)))
+        n = int(np.prod([len(domains[name]) for name in inputs]))
+        assigned = enumerate_U(inputs, domains, 0, n)
+        values = evaluate(F[V_i], assigned, n)
+        domains[V_i], index = np.unique(values, return_inverse=True)
+        table = np.zeros((n, len(domains[V_i])))
+        table[np.arange(n), index.ravel()] = 1
+        factors.append((tuple(inputs) + (V_i,), table.reshape([len(domains[name]) for name in inputs] + [-1])))
+    return factors, domains
+
+
+def elimination_query(
+    F: dict, G, U: Sequence[str], D, P_U: Callable, outcome: Tuple, condition: dict, intervention: dict
+) -> Tuple[Dict[tuple, float], float, List[dict]]:
+    """Unnormalized P(outcome, condition | do(intervention)) and the normalizer, as vectorized_query, by variable
+    elimination on the ancestral closure of the outcome and condition variables.
+
+    Cost is exponential in the width of the elimination order rather than in the number of background variables.
+    Outcomes of zero probability are left out, as query00 skips configurations of zero probability.
+    """
+    targets = list(outcome) + list(condition)
+    V_ordered, U, scale = ancestral_closure(F, G, U, D, P_U, targets, intervention)
+    factors, domains = compile_factors(F, G, V_ordered, U, D, P_U, intervention)
+    for V_i, value in condition.items():
+        factors.append(((V_i,), (domains[V_i] == value).astype(float)))
+
+    cards = {name: len(domain) for name, domain in domains.items()}
+    factors = eliminate(factors, [name for name in cards if name not in outcome], cards)
+    scope, joint = multiply_out(factors, outcome)
+    joint = np.moveaxis(joint, [scope.index(V_i) for V_i in outcome], range(len(outcome))) * scale
+
+    prob_outcome = dict()
+    for index in zip(*np.nonzero(joint)):
+        key = tuple(domains[V_i][i].item() for V_i, i in zip(outcome, index))
+        prob_outcome[key] = prob_outcome.get(key, 0) + float(joint[index])
+    return prob_outcome, float(joint.sum()), []
@@ -0,0 +1,203 @@
+import numpy as np
+import weakref
+from itertools import product
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from scm_mab.inference import ancestral_closure, enumerate_U, equation_inputs, evaluate, marginal_probabilities
+
+""" Closed-form inference on structural causal models whose equations are XOR-affine (linear over GF(2)) """
+
+AFFINE_CHECK_LIMIT = 16  # equations with more inputs are only taken as affine if declared with AffineEquation
+PARITY_TARGET_LIMIT = 12  # the joint distribution of the outcome and condition variables has 2^targets entries
+ZERO_TOLERANCE = 1e-12  # masses below this fraction of the total are rounding errors of the transform
+
+Form = Tuple[int, int]  # bitmask of the background variables XOR-ed together and the constant XOR-ed with them
+
+_affine_forms = weakref.WeakKeyDictionary()  # equation -> {inputs: (constant, XOR-ed inputs)}, detection is cached
+
+
+class AffineEquation:
+    """
+    Structural equation declared as the XOR of a constant and of variables, which is not checked for affinity.
+
+    Parameters
+    ----------
+    inputs : Sequence[str]
+        Variables (endogenous or background) XOR-ed together
+    constant : int
+        Zero or one
+    """
+
+    def __init__(self, inputs: Sequence[str], constant: int = 0):
+        self.inputs = tuple(inputs)
+        self.constant = constant
+
+    def __call__(self, v):
+        value = self.constant
+        for name in self.inputs:
+            value = value ^ v[name]
+        return value
+
+
+def affine_form(f: Callable, inputs: Sequence[str]) -> Optional[Tuple[int, Tuple[str, ...]]]:
+    """The constant and the inputs XOR-ed by f if it is affine over GF(2) for binary inputs, else None.
+
+    The form is read off f at zero and at the unit vectors, and is then checked on every one of the 2^len(inputs)
+    configurations, so that any equation which is affine on binary values is found (e.g. a ^ 1 or a + b - 2 * a * b).
+    """
+    if isinstance(f, AffineEquation):
+        return f.constant, f.inputs
+    inputs = tuple(inputs)
+    try:
+        cached = _affine_forms.setdefault(f, dict())
+    except TypeError:  # not weakly referenceable
+        cached = dict()
+    if inputs in cached:
+        return cached[inputs]
+
+    form = None
+    n = 1 << len(inputs)
+    if len(inputs) <= AFFINE_CHECK_LIMIT:
+        assigned = enumerate_U(inputs, {name: (0, 1) for name in inputs}, 0, n)
+        try:
+            values = evaluate(f, assigned, n)
+        except Exception:
+            values = None
+        if values is not None and np.isin(values, (0, 1)).all():
+            constant = int(values[0])
+            # the last input is the fastest varying digit of the enumeration
+            xored = tuple(name for i, name in enumerate(inputs) if values[n >> (i + 1)] != constant)
+            predicted = np.full((n,), constant)
+            for name in xored:
+                predicted ^= assigned[name]
+            if np.array_equal(predicted, values):
+                form = constant, xored
+    cached[inputs] = form
+    return form
+
+
+def equation_forms(F: dict, G, V_ordered: Sequence[str], U: Sequence[str], D) -> Optional[Dict[str, tuple]]:
+    """ The affine_form of the equation of every variable of V_ordered, None unless they are all affine """
+    equations = dict()
+    for V_i in V_ordered:
+        inputs = sorted(equation_inputs(F, G, V_i, U, D))
+        equations[V_i] = affine_form(F[V_i], inputs)
+        if equations[V_i] is None:
+            return None
+    return equations
+
+
+def propagate(equations: dict, V_ordered: Sequence[str], intervention: dict, forms: Dict[str, Form]) -> Optional[dict]:
+    """The forms of V_ordered (in causal order) in terms of the background variables, added to those of forms, None if
+    an intervention is not binary"""
+    for V_i in V_ordered:
+        if V_i in intervention:
+            if intervention[V_i] not in (0, 1):
+                return None
+            forms[V_i] = (0, int(intervention[V_i]))
+            continue
+        mask, constant = 0, equations[V_i][0]
+        for name in equations[V_i][1]:
+            mask, constant = mask ^ forms[name][0], constant ^ forms[name][1]
+        forms[V_i] = (mask, constant)
+    return forms
+
+
+def affine_forms(
+    F: dict, G, V_ordered: Sequence[str], U: Sequence[str], D, intervention: dict
+) -> Optional[Dict[str, Form]]:
+    """The form of every variable of V_ordered and U in terms of the (binary) background variables U, None unless they
+    are all affine"""
+    if any(sorted(D[U_i]) != [0, 1] for U_i in U):
+        return None
+    equations = equation_forms(F, G, [V_i for V_i in V_ordered if V_i not in intervention], U, D)
+    if equations is None:
+        return None
+    return propagate(equations, V_ordered, intervention, {U_i: (1 << j, 0) for j, U_i in enumerate(U)})
+
+
+def parity_weights(P_U: Callable, U: Sequence[str], D) -> np.ndarray:
+    """ (len(U), 2) masses of the values 0 and 1 of each background variable, U being of product form """
+    weights = np.zeros((len(U), 2))
+    for j, (U_i, marginal) in enumerate(zip(U, marginal_probabilities(P_U, U, D))):
+        weights[j] = marginal[list(D[U_i]).index(0)], marginal[list(D[U_i]).index(1)]
+    return weights
+
+
+def parity_distribution(forms: Sequence[Form], weights: np.ndarray) -> np.ndarray:
+    """Unnormalized joint distribution, shape (2,) * len(forms), of affine functions of independent binary variables.
+
+    weights is (len(U), 2), the masses of the values 0 and 1 of each background variable. The mass of every parity of
+    the functions is the product formula, prod(w0 - w1) over the variables it XORs times prod(w0 + w1) over the others
+    (with the sign of its constant), and the distribution is the Walsh-Hadamard transform of these masses.
+    """
+    m = len(forms)
+    subsets = np.array(list(product((0, 1), repeat=m)), dtype=np.int64).reshape(-1, m)
+    masks = np.array([[(mask >> j) & 1 for j in range(len(weights))] for mask, _ in forms], dtype=np.int64)
+    constants = np.array([constant for _, constant in forms], dtype=np.int64)
+
+    xored = (subsets @ masks.reshape(m, -1)) % 2
+    signs = 1 - 2 * ((subsets @ constants) % 2)
+    characteristic = signs * np.prod(np.where(xored, weights[:, 0] - weights[:, 1], weights.sum(axis=1)), axis=1)
+    hadamard = 1 - 2 * ((subsets @ subsets.T) % 2)
+    return (hadamard @ characteristic / len(subsets)).reshape((2,) * m)
+
+
+def parity_query(
+    F: dict, G, U: Sequence[str], D, P_U: Callable, outcome: Tuple, condition: dict, intervention: dict
+) -> Optional[Tuple[Dict[tuple, float], float, List[dict]]]:
+    """vectorized_query in time polynomial in the number of variables, for binary background variables of product
+    form and affine equations in the ancestral closure of the outcome and condition variables (None otherwise).
+
+    Outcomes whose mass is within rounding error of zero are left out.
+    """
+    targets = list(dict.fromkeys(list(outcome) + list(condition)))
+    if len(targets) > PARITY_TARGET_LIMIT or marginal_probabilities(P_U, U, D) is None:
+        return None
+    V_ordered, U, scale = ancestral_closure(F, G, U, D, P_U, targets, intervention)
+    forms = affine_forms(F, G, V_ordered, U, D, intervention)
+    if forms is None:
+        return None
+
+    weights = parity_weights(P_U, U, D)
+    joint = parity_distribution([forms[V_i] for V_i in targets], weights) * scale
+    tolerance = ZERO_TOLERANCE * np.prod(weights.sum(axis=1)) * scale
+
+    prob_outcome, normalizer = dict(), 0.0
+    for values in product((0, 1), repeat=len(targets)):
+        assigned = dict(zip(targets, values))
+        if joint[values] <= tolerance or any(assigned[V_i] != value for V_i, value in condition.items()):
+            continue
+        key = tuple(assigned[V_i] for V_i in outcome)
+        prob_outcome[key] = prob_outcome.get(key, 0) + float(joint[values])
+        normalizer += float(joint[values])
+    return prob_outcome, normalizer, []
+
+
+def parity_expectations(
+    F: dict, G, U: Sequence[str], D, P_U: Callable, reward_variable: str, arms: Sequence[dict]
+) -> Optional[Tuple[np.ndarray, float]]:
+    """vectorized_expectations in closed form, None unless parity_query applies to the model without intervention.
+
+    The forms of the model without intervention are shared by all arms, each arm only recomputes those of the
+    descendants (in G) of the variables it intervenes on.
+    """
+    if marginal_probabilities(P_U, U, D) is None:
+        return None
+    V_ordered, U, scale = ancestral_closure(F, G, U, D, P_U, [reward_variable], dict())
+    natural = affine_forms(F, G, V_ordered, U, D, dict())
+    if natural is None:
+        return None
+    equations = equation_forms(F, G, V_ordered, U, D)
+    weights = parity_weights(P_U, U, D)
+    total = float(np.prod(weights.sum(axis=1))) * scale
+
+    reward_mass = np.zeros((len(arms),))
+    for a, arm in enumerate(arms):
+        V_changed = [V_i for V_i in V_ordered if V_i in G.De(set(arm))]
+        forms = propagate(equations, V_changed, arm, dict(natural))
+        if forms is None:
+            return None
+        masses = parity_distribution([forms[reward_variable]], weights) * scale
+        reward_mass[a] = sum(y_val * masses[y_val] for y_val in (0, 1) if y_val in D[reward_variable])
+    return reward_mass, total
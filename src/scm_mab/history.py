@@ -0,0 +1,214 @@
+import numpy as np
+from typing import Dict, Sequence, Tuple
+
+from scm_mab.utils import arm_dtype
+
+""" Compact storage and streaming summaries of the arms played and rewards received over several bandit trials """
+
+
+class BanditHistory:
+    """
+    Compact (n_trials, T) history of arms played and Bernoulli rewards.
+
+    Arm indices are kept in the smallest unsigned type and rewards are bit-packed. With run_length=True the arms are
+    run-length encoded, which pays off once the bandits converge and keep playing the same arm. The arms and rewards
+    properties decode to plain arrays, e.g. for compute_cumulative_regret and compute_optimality, and a history unpacks
+    into them as the (arms_selected, rewards) of play_bandits, while frequency and prob_arm_optimality are computed from
+    the encoding directly.
+
+    Parameters
+    ----------
+    arms_selected : np.ndarray
+        (n_trials, T) arms played
+    rewards : np.ndarray
+        (n_trials, T) rewards, zero or one
+    n_arms : int, optional
+        Number of arms (the largest arm played plus one if not given)
+    run_length : bool
+        Run-length encode the arms
+    """
+
+    def __init__(self, arms_selected: np.ndarray, rewards: np.ndarray, n_arms: int = None, run_length=False):
+        arms_selected = np.asarray(arms_selected)
+        assert arms_selected.ndim == 2 and arms_selected.shape == np.shape(rewards)
+        self.shape = arms_selected.shape
+        self.n_arms = n_arms if n_arms is not None else int(arms_selected.max(initial=0)) + 1
+        self.run_length = run_length
+        self.packed_rewards = np.packbits(np.asarray(rewards, dtype=bool), axis=1)
+
+        dtype = arm_dtype(self.n_arms)
+        if run_length:
+            flat = arms_selected.ravel()
+            # a run starts wherever the arm changes or a new trial begins
+            starts = np.flatnonzero(np.diff(flat, prepend=flat[:1] ^ 1) != 0)
+            starts = np.union1d(starts, np.arange(0, flat.size, self.shape[1]))
+            self.run_values = flat[starts].astype(dtype)
+            self.run_starts = starts.astype(np.min_scalar_type(flat.size))
+            self._arms = None
+        else:
+            self._arms = arms_selected.astype(dtype)
+
+    def __iter__(self):
+        return iter(self.arrays())
+
+    @property
+    def n_trials(self) -> int:
+        return self.shape[0]
+
+    @property
+    def run_lengths(self) -> np.ndarray:
+        return np.diff(self.run_starts.astype(np.int64), append=np.prod(self.shape))
+
+    @property
+    def arms(self) -> np.ndarray:
+        if self._arms is not None:
+            return self._arms
+        return np.repeat(self.run_values, self.run_lengths).reshape(self.shape)
+
+    @property
+    def rewards(self) -> np.ndarray:
+        return np.unpackbits(self.packed_rewards, axis=1, count=self.shape[1])
+
+    @property
+    def nbytes(self) -> int:
+        if self._arms is not None:
+            return self._arms.nbytes + self.packed_rewards.nbytes
+        return self.run_values.nbytes + self.run_starts.nbytes + self.packed_rewards.nbytes
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Decoded (arms_selected, rewards) as returned by play_bandits """
+        return self.arms, self.rewards
+
+    def relabeled(self, arm_ids: np.ndarray) -> "BanditHistory":
+        """The history with arm i renamed arm_ids[i], e.g. the index of a subset's arm in the full bandit machine, which
+        only relabels the runs if run-length encoded"""
+        arm_ids = np.asarray(arm_ids)
+        history = BanditHistory.__new__(BanditHistory)
+        history.shape, history.n_arms, history.run_length = self.shape, int(arm_ids.max(initial=0)) + 1, self.run_length
+        history.packed_rewards = self.packed_rewards
+        dtype = arm_dtype(history.n_arms)
+        if self._arms is not None:
+            history._arms = arm_ids[self._arms].astype(dtype)
+        else:
+            history.run_values, history.run_starts = arm_ids[self.run_values].astype(dtype), self.run_starts
+            history._arms = None
+        return history
+
+    def arm_counts(self) -> np.ndarray:
+        """ Number of times each arm was played (over all trials) """
+        if self._arms is not None:
+            return np.bincount(self._arms.ravel(), minlength=self.n_arms)
+        return np.bincount(self.run_values, weights=self.run_lengths, minlength=self.n_arms).astype(np.int64)
+
+    def arm_successes(self) -> np.ndarray:
+        """ Sum of the rewards of each arm (over all trials) """
+        return np.bincount(self.arms.ravel(), weights=self.rewards.ravel(), minlength=self.n_arms).astype(np.int64)
+
+    def frequency(self) -> Dict[int, int]:
+        """ Number of times each arm was played (over all trials), as in get_results """
+        return {arm: count for arm, count in enumerate(self.arm_counts().tolist()) if count}
+
+    def prob_arm_optimality(self, mu) -> np.ndarray:
+        """ Fraction of trials playing an optimal arm at each round """
+        is_optimal = np.asarray(mu) == np.max(mu)
+        if self._arms is not None:
+            return np.mean(is_optimal[self._arms], axis=0)
+
+        # +1 where an optimal run starts and -1 where it ends, per round of the trial it belongs to
+        T = self.shape[1]
+        starts = self.run_starts[is_optimal[self.run_values]].astype(np.int64)
+        ends = starts + self.run_lengths[is_optimal[self.run_values]]
+        counts = np.bincount(starts % T, minlength=T + 1)[: T + 1].astype(np.int64)
+        counts -= np.bincount(np.where(ends % T == 0, T, ends % T), minlength=T + 1)
+        return np.cumsum(counts[:T]) / self.shape[0]
+
+
+class TrialAggregate:
+    """
+    Running summary of bandit trials which never holds their (n_trials, T) histories.
+
+    Trials are folded in one at a time (or a few rows at a time) into Welford accumulators of the per-round mean and
+    variance of the cumulative regret, per-round counts of optimal plays and per-arm play and success counts. Memory is
+    O(T + K) whatever the number of trials, and aggregates of disjoint sets of trials can be merged.
+
+    Parameters
+    ----------
+    T : int
+        Horizon
+    mu : Sequence
+        Expected reward per arm, shared by all trials (K,) or per trial (n_trials, K), in which case add is given the
+        rows of the trials it folds in
+    mu_star : float, optional
+        Reward of the optimal arm, defaults to the largest of each trial's mu (pass the full machine's when mu is a
+        subset of its arms)
+    """
+
+    def __init__(self, T: int, mu: Sequence, mu_star: float = None):
+        self.T = T
+        self.mu = np.asarray(mu, dtype=float)
+        self.n_arms = self.mu.shape[-1]
+        self.mu_star = mu_star
+        self.n_trials = 0
+        self.regret_mean = np.zeros((T,))
+        self.regret_M2 = np.zeros((T,))  # sum of squared deviations from the mean
+        self.optimal_counts = np.zeros((T,), dtype=np.int64)
+        self.arm_counts = np.zeros((self.n_arms,), dtype=np.int64)
+        self.arm_successes = np.zeros((self.n_arms,), dtype=np.int64)
+
+    def add(self, arms_selected: np.ndarray, rewards: np.ndarray, mu: Sequence = None):
+        """Fold in one trial, shape (T,), or a block of trials, shape (n, T), whose expected rewards are mu (one row
+        per trial or one shared by all), those given to the constructor by default"""
+        arms_selected, rewards = np.atleast_2d(arms_selected), np.atleast_2d(rewards)
+        n = len(arms_selected)
+        mu = np.broadcast_to(self.mu if mu is None else np.asarray(mu, dtype=float), (n, self.n_arms))
+        mu_star = mu.max(axis=1) if self.mu_star is None else np.full((n,), self.mu_star)
+        cumulative_regret = np.outer(mu_star, np.arange(1, self.T + 1)) - np.cumsum(rewards, axis=1)
+
+        block = TrialAggregate.__new__(TrialAggregate)
+        block.n_trials = n
+        block.regret_mean = cumulative_regret.mean(axis=0)
+        block.regret_M2 = ((cumulative_regret - block.regret_mean) ** 2).sum(axis=0)
+        played = np.take_along_axis(mu, arms_selected.astype(np.intp), axis=1)
+        block.optimal_counts = np.count_nonzero(played == mu_star[:, None], axis=0)
+        block.arm_counts = np.bincount(arms_selected.ravel(), minlength=self.n_arms)
+        block.arm_successes = np.bincount(arms_selected.ravel(), weights=rewards.ravel(), minlength=self.n_arms)
+        block.arm_successes = block.arm_successes.astype(np.int64)
+        self.merge(block)
+
+    def merge(self, other: "TrialAggregate") -> "TrialAggregate":
+        """ Fold in another aggregate (pairwise update of Chan et al.) """
+        n = self.n_trials + other.n_trials
+        if other.n_trials:
+            delta = other.regret_mean - self.regret_mean
+            self.regret_mean = self.regret_mean + delta * (other.n_trials / n)
+            self.regret_M2 = self.regret_M2 + other.regret_M2 + delta ** 2 * (self.n_trials * other.n_trials / n)
+            self.optimal_counts += other.optimal_counts
+            self.arm_counts += other.arm_counts
+            self.arm_successes += other.arm_successes
+            self.n_trials = n
+        return self
+
+    @property
+    def regret_std(self) -> np.ndarray:
+        """ Standard deviation over trials (as np.std, i.e. without the n - 1 correction) """
+        return np.sqrt(self.regret_M2 / max(self.n_trials, 1))
+
+    @property
+    def prob_arm_optimality(self) -> np.ndarray:
+        return self.optimal_counts / max(self.n_trials, 1)
+
+    def results(self, arm_ids: Sequence[int] = None) -> dict:
+        """The keys of get_results, arm_ids mapping arm indices to those of the full bandit machine.
+
+        The (n_trials, T) cumulative_regret and arm_optimality matrices are replaced by their means over trials as a
+        single row, which averaging over trials (axis 0) leaves as is. cumulative_regret_std and n_trials are added.
+        """
+        arm_ids = range(self.n_arms) if arm_ids is None else arm_ids
+        return {
+            "cumulative_regret": self.regret_mean[None, :],
+            "arm_optimality": self.prob_arm_optimality[None, :],
+            "prob_arm_optimality": self.prob_arm_optimality,
+            "frequency": {arm_ids[arm]: count for arm, count in enumerate(self.arm_counts.tolist()) if count},
+            "cumulative_regret_std": self.regret_std,
+            "n_trials": self.n_trials,
+        }
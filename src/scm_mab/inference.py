@@ -0,0 +1,504 @@
+import numpy as np
+from itertools import product
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+""" Exact inference on structural causal models, enumerating the joint space of the background variables with arrays """
+
+ENUMERATION_CHUNK = 1 << 16  # background configurations evaluated at once, bounds the memory of the engine
+GRAY_RESYNC = 1 << 10  # Gray code steps between recomputations of P(u), which bounds the drift of its updates
+
+
+def static_equations(F):
+    """ The structural equations of a time-slice free SEM, F being either a SEM class (with static()) or a dict """
+    return F.static() if hasattr(F, "static") else F
+
+
+def marginal_probabilities(P_U: Callable, U: Sequence[str], D) -> Optional[List[np.ndarray]]:
+    """Per-variable probability vectors (over D[U_i]) if P_U is of product form, as made by default_P_U, else None.
+
+    Mirrors default_P_U: a value of zero has probability 1 - mu[U_i], any other value mu[U_i], and background
+    variables without a mu are left out of the product.
+    """
+    mu = getattr(P_U, "mu", None)
+    if mu is None:
+        return None
+    return [
+        np.array([(1 - mu[U_i]) if value == 0 else mu[U_i] for value in D[U_i]]) if U_i in mu else np.ones(len(D[U_i]))
+        for U_i in U
+    ]
+
+
+class _Recorder(dict):
+    """ Variables dictionary which records the variables read from it, their trace values are made on first read """
+
+    def __init__(self, names: Sequence[str], D):
+        super().__init__()
+        self.names = set(names)
+        self.D = D
+        self.read = set()
+
+    def __missing__(self, key):
+        if key not in self.names:
+            raise KeyError(key)
+        self[key] = np.resize(np.asarray(self.D[key]), 2)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def __getitem__(self, key):
+        self.read.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.names else default
+
+
+def read_variables(f: Callable, names: Sequence[str], D) -> Optional[set]:
+    """The variables read by a structural equation, traced by evaluating it on arrays of values.
+
+    An equation which does not support arrays could hide reads behind branches on values, so None (unknown) is
+    returned for it, as for any equation failing on the trace.
+    """
+    recorder = _Recorder(names, D)
+    try:
+        f(recorder)
+    except Exception:
+        return None
+    return recorder.read
+
+
+def equation_inputs(F: dict, G, V_i: str, U: Sequence[str], D) -> set:
+    """The variables (of V and U) the equation of V_i depends on: its parents and confounders in G and the variables it
+    is traced to read, or all of U if it cannot be traced"""
+    U_set = set(U)
+    read = read_variables(F[V_i], list(G.V) + list(U), D) if V_i in F else None
+    if read is None:
+        return G.pa(V_i) | U_set
+    return G.pa(V_i) | (G.UCs(V_i) & U_set) | (read & (G.V | U_set))
+
+
+def ancestral_closure(
+    F: dict, G, U: Sequence[str], D, P_U: Callable, targets: Sequence[str], intervention: dict
+) -> Tuple[List[str], List[str], float]:
+    """The variables of V and U a query on targets depends on, in G.do(intervention).
+
+    Endogenous variables are closed under the inputs of their equations (see equation_inputs), except for intervened
+    ones which depend on nothing. Returns the endogenous variables in causal order, the background variables to
+    enumerate and the factor by which summing out the others scales probabilities. The latter are only left out for a
+    P_U of product form, where summing them out is a product of marginal sums.
+    """
+    U_set = set(U)
+    relevant, exogenous, to_visit = set(), set(), list(targets)
+    while to_visit:
+        V_i = to_visit.pop()
+        if V_i in relevant:
+            continue
+        relevant.add(V_i)
+        if V_i in intervention:
+            continue
+        inputs = equation_inputs(F, G, V_i, U, D)
+        exogenous |= inputs & U_set
+        to_visit += inputs - U_set - relevant
+
+    V_relevant = [V_i for V_i in G.causal_order() if V_i in relevant]
+    marginals = marginal_probabilities(P_U, U, D)
+    if marginals is None:
+        return V_relevant, list(U), 1.0
+    scale = float(np.prod([marginal.sum() for U_i, marginal in zip(U, marginals) if U_i not in exogenous]))
+    return V_relevant, [U_i for U_i in U if U_i in exogenous], scale
+
+
+def enumerate_U(U: Sequence[str], D, start: int, stop: int) -> Dict[str, np.ndarray]:
+    """Configurations start, ..., stop - 1 of the background variables, in the order of itertools.product.
+
+    Configuration k is the mixed-radix number whose digits index the domains of U, the last variable being the
+    fastest varying digit.
+    """
+    index = np.arange(start, stop)
+    assigned = dict()
+    stride = 1
+    for U_i in reversed(U):
+        domain = np.asarray(D[U_i])
+        assigned[U_i] = domain[(index // stride) % len(domain)]
+        stride *= len(domain)
+    return assigned
+
+
+def probabilities(P_U: Callable, marginals: Optional[List[np.ndarray]], assigned: dict, U: Sequence[str], D, n: int):
+    """P(u) of the n enumerated configurations, a product of the marginals if P_U is of product form"""
+    if marginals is None:
+        return np.array([P_U({U_i: assigned[U_i][k] for U_i in U}) for k in range(n)], dtype=float)
+
+    p_u = np.ones((n,))
+    for U_i, marginal in zip(U, marginals):
+        domain = np.asarray(D[U_i])
+        order = np.argsort(domain)
+        p_u *= marginal[order[np.searchsorted(domain[order], assigned[U_i])]]
+    return p_u
+
+
+def evaluate(f: Callable, assigned: dict, n: int) -> np.ndarray:
+    """Evaluate a structural equation on whole arrays, or one configuration at a time if it does not support arrays
+    (e.g. it branches on a value with if, and or or)"""
+    try:
+        value = np.asarray(f(assigned))
+        if value.shape == ():
+            return np.full((n,), value)
+        if value.shape == (n,):
+            return value
+    except (TypeError, ValueError, IndexError):
+        pass
+    return np.array([f({k: v[i] for k, v in assigned.items()}) for i in range(n)])
+
+
+def solve(F: dict, V_ordered: Sequence[str], intervention: dict, assigned: dict, n: int) -> dict:
+    """ Values of the endogenous variables (in place of assigned), as _assign but for n configurations at once """
+    for V_i in V_ordered:
+        if V_i in intervention:
+            assigned[V_i] = np.full((n,), intervention[V_i])
+        else:
+            assigned[V_i] = evaluate(F[V_i], assigned, n)
+    return assigned
+
+
+def solve_consistent(
+    F: dict, V_ordered: Sequence[str], intervention: dict, condition: dict, assigned: dict, n: int
+) -> Tuple[dict, np.ndarray]:
+    """solve, dropping the configurations which disagree with condition as soon as a conditioned variable is assigned
+    (in causal order), so that the variables after it are only evaluated on the others.
+
+    Returns the values of the consistent configurations and their indices among the n. If there are none, the
+    variables after the last conditioned one are left unassigned.
+    """
+    kept = np.arange(n)
+    for V_i in V_ordered:
+        if V_i in intervention:
+            assigned[V_i] = np.full((len(kept),), intervention[V_i])
+        else:
+            assigned[V_i] = evaluate(F[V_i], assigned, len(kept))
+        if V_i in condition:
+            met = assigned[V_i] == condition[V_i]
+            if not met.all():
+                assigned, kept = {key: values[met] for key, values in assigned.items()}, kept[met]
+            if not len(kept):
+                break
+    return assigned, kept
+
+
+def _enumeration(
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    outcome: Tuple,
+    condition: dict,
+    intervention: dict,
+    skip_zero: bool,
+    keep_states: bool,
+    chunk_size: int,
+    start: int = 0,
+    stop: int = None,
+) -> Tuple[Dict[tuple, float], float, Dict[tuple, float]]:
+    """The pass of vectorized_query and vectorized_slice over configurations start, ..., stop - 1 of U (all by
+    default), the states being mapped to their (unnormalized) mass"""
+    marginals = marginal_probabilities(P_U, U, D)
+    if stop is None:
+        stop = int(np.prod([len(D[U_i]) for U_i in U]))
+    prob_outcome = dict()
+    normalizer = 0.0
+    states = dict()
+    for chunk_start in range(start, stop, chunk_size):
+        n = min(chunk_size, stop - chunk_start)
+        assigned = enumerate_U(U, D, chunk_start, chunk_start + n)
+        p_u = probabilities(P_U, marginals, assigned, U, D, n)
+        if skip_zero and not p_u.all():
+            kept = p_u != 0
+            assigned = {U_i: values[kept] for U_i, values in assigned.items()}
+            p_u, n = p_u[kept], int(np.count_nonzero(kept))
+
+        assigned, kept = solve_consistent(F, V_ordered, intervention, condition, assigned, n)
+        p_u = p_u[kept]
+        if not len(p_u):
+            continue
+
+        normalizer += float(p_u.sum())
+        outcomes, inverse = np.unique(np.stack([assigned[V_i] for V_i in outcome], axis=1), axis=0, return_inverse=True)
+        for key, p in zip(map(tuple, outcomes.tolist()), np.bincount(inverse.ravel(), weights=p_u).tolist()):
+            prob_outcome[key] = prob_outcome.get(key, 0) + p
+        if keep_states:
+            reached, inverse = np.unique(
+                np.stack([assigned[V_i] for V_i in V_ordered], axis=1), axis=0, return_inverse=True
+            )
+            for state, p in zip(map(tuple, reached.tolist()), np.bincount(inverse.ravel(), weights=p_u).tolist()):
+                states[state] = states.get(state, 0) + p
+
+    return prob_outcome, normalizer, states
+
+
+def vectorized_query(
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    outcome: Tuple,
+    condition: dict,
+    intervention: dict,
+    skip_zero=True,
+    keep_states=False,
+    chunk_size=ENUMERATION_CHUNK,
+) -> Tuple[Dict[tuple, float], float, List[dict]]:
+    """Unnormalized P(outcome, condition | do(intervention)) by enumerating the configurations of U in chunks.
+
+    Returns the probability of each outcome jointly with the condition, the probability of the condition (the
+    normalizer of query00) and, with keep_states, the distinct values of V_ordered among the configurations meeting the
+    condition. Configurations of zero probability are skipped with skip_zero, as in query00.
+    """
+    prob_outcome, normalizer, states = _enumeration(
+        F, V_ordered, U, D, P_U, outcome, condition, intervention, skip_zero, keep_states, chunk_size
+    )
+    return prob_outcome, normalizer, [dict(zip(V_ordered, state)) for state in sorted(states)]
+
+
+def vectorized_slice(
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    outcome: Tuple,
+    intervention: dict,
+    skip_zero=False,
+    chunk_size=ENUMERATION_CHUNK,
+) -> Tuple[Dict[tuple, float], float, np.ndarray, np.ndarray]:
+    """vectorized_query of a whole time-slice (without condition) which keeps the mass of each state it reaches.
+
+    Returns the outcome masses, the normalizer, the distinct values of V_ordered reached (one row per state, sorted)
+    and their masses.
+    """
+    prob_outcome, normalizer, states = _enumeration(
+        F, V_ordered, U, D, P_U, outcome, dict(), intervention, skip_zero, True, chunk_size
+    )
+    reached = sorted(states)
+    rows = np.array(reached).reshape(len(reached), len(V_ordered))
+    return prob_outcome, normalizer, rows, np.array([states[state] for state in reached], dtype=float)
+
+
+def vectorized_expectations(
+    F: dict,
+    G,
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    reward_variable: str,
+    arms: Sequence[dict],
+    skip_zero=True,
+    chunk_size=ENUMERATION_CHUNK,
+) -> Tuple[np.ndarray, float]:
+    """Unnormalized expected reward of every arm (an intervention) and the normalizer shared by all arms.
+
+    Every chunk of U configurations and its probabilities are enumerated once and the model is solved once without
+    intervention, then each arm only re-evaluates the descendants (in G) of the variables it intervenes on. Only the
+    ancestral closure of the reward variable is enumerated and solved, interventions only cut it down further. Rewards
+    outside of the domain of the reward variable are not counted, as when summing query's distribution over it.
+    """
+    V_ordered, U, scale = ancestral_closure(F, G, U, D, P_U, [reward_variable], dict())
+    changed = arm_descendants(G, V_ordered, arms)
+    arguments = F, V_ordered, U, D, P_U, reward_variable, arms, changed, skip_zero, chunk_size
+    reward_mass, normalizer = _expectations(*arguments)
+    return reward_mass * scale, normalizer * scale
+
+
+def arm_descendants(G, V_ordered: Sequence[str], arms: Sequence[dict]) -> List[List[str]]:
+    """ The variables of V_ordered which each arm's intervention may change, i.e. its descendants in G """
+    return [[V_i for V_i in V_ordered if V_i in G.De(set(arm))] for arm in arms]
+
+
+def _expectations(
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    reward_variable: str,
+    arms: Sequence[dict],
+    changed: Sequence[Sequence[str]],
+    skip_zero: bool,
+    chunk_size: int,
+    start: int = 0,
+    stop: int = None,
+) -> Tuple[np.ndarray, float]:
+    """The pass of vectorized_expectations over configurations start, ..., stop - 1 of U (all by default), changed
+    being the variables each arm re-evaluates"""
+    D_Y = np.asarray(D[reward_variable])
+    marginals = marginal_probabilities(P_U, U, D)
+    if stop is None:
+        stop = int(np.prod([len(D[U_i]) for U_i in U]))
+    reward_mass = np.zeros((len(arms),))
+    normalizer = 0.0
+    for chunk_start in range(start, stop, chunk_size):
+        n = min(chunk_size, stop - chunk_start)
+        assigned = enumerate_U(U, D, chunk_start, chunk_start + n)
+        p_u = probabilities(P_U, marginals, assigned, U, D, n)
+        if skip_zero and not p_u.all():
+            kept = p_u != 0
+            assigned = {U_i: values[kept] for U_i, values in assigned.items()}
+            p_u, n = p_u[kept], int(np.count_nonzero(kept))
+
+        normalizer += float(p_u.sum())
+        natural = solve(F, V_ordered, dict(), assigned, n)
+        for a, (arm, V_changed) in enumerate(zip(arms, changed)):
+            values = solve(F, V_changed, arm, dict(natural), n)
+            Y = values[reward_variable]
+            reward_mass[a] += np.dot(p_u, np.where(np.isin(Y, D_Y), Y, 0))
+
+    return reward_mass, normalizer
+
+
+def loop_query(
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    outcome: Tuple,
+    condition: dict,
+    intervention: dict,
+    skip_zero=True,
+    keep_states=False,
+) -> Tuple[Dict[tuple, float], float, List[dict]]:
+    """vectorized_query one configuration at a time, as originally done by query00 and query01, except that a
+    configuration is dropped as soon as a conditioned variable disagrees with the condition"""
+    prob_outcome = dict()
+    normalizer = 0
+    states = list()
+    for u in product(*[D[U_i] for U_i in U]):  # d^|U|
+        assigned = dict(zip(U, u))
+        p_u = P_U(assigned)
+        if skip_zero and p_u == 0:
+            continue
+        consistent = all(assigned[U_i] == condition[U_i] for U_i in U if U_i in condition)
+        for V_i in V_ordered if consistent else ():
+            if V_i in intervention:
+                assigned[V_i] = intervention[V_i]
+            else:
+                assigned[V_i] = F[V_i](assigned)
+            if V_i in condition and not assigned[V_i] == condition[V_i]:
+                consistent = False  # whatever the variables after it
+                break
+        if not consistent:
+            continue
+        normalizer += p_u
+        key = tuple(assigned[V_i] for V_i in outcome)
+        prob_outcome[key] = prob_outcome.get(key, 0) + p_u
+        if keep_states:
+            states.append({V_i: assigned[V_i] for V_i in V_ordered})
+
+    return prob_outcome, normalizer, states
+
+
+def gray_code(radices: Sequence[int]):
+    """The steps of the reflected mixed-radix Gray code (loopless, Algorithm H of Knuth, TAOCP 7.2.1.1) from the
+    all-zero configuration, as (digit, new value) pairs, each step changing one digit by one. Radices are at least 2."""
+    n = len(radices)
+    values, directions, focus = [0] * n, [1] * n, list(range(n + 1))
+    while True:
+        j = focus[0]
+        focus[0] = 0
+        if j == n:
+            return
+        values[j] += directions[j]
+        yield j, values[j]
+        if values[j] == 0 or values[j] == radices[j] - 1:
+            directions[j] = -directions[j]
+            focus[j] = focus[j + 1]
+            focus[j + 1] = j + 1
+
+
+def gray_query(
+    F: dict,
+    G,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    outcome: Tuple,
+    condition: dict,
+    intervention: dict,
+    skip_zero=True,
+    keep_states=False,
+) -> Tuple[Dict[tuple, float], float, List[dict]]:
+    """loop_query walking the configurations of U in Gray code order, so that each step changes a single background
+    variable and only re-evaluates the endogenous variables it reaches in G (through the inputs of their equations and
+    then G.ch). For a P_U of product form the probability is updated by the ratio of the changed marginal."""
+    domains = [list(D[U_i]) for U_i in U]
+    if not all(domains):
+        return dict(), 0, []
+    varying = [k for k, domain in enumerate(domains) if len(domain) > 1]
+    index = [0] * len(U)
+    assigned = {U_i: domain[0] for U_i, domain in zip(U, domains)}
+
+    # endogenous variables to re-evaluate when each background variable changes, in causal order
+    position = {V_i: k for k, V_i in enumerate(V_ordered)}
+    inputs = {V_i: equation_inputs(F, G, V_i, U, D) for V_i in V_ordered if V_i not in intervention}
+    dependents = dict()
+    for k in varying:
+        reached, to_visit = set(), [V_i for V_i in inputs if U[k] in inputs[V_i]]
+        while to_visit:
+            V_i = to_visit.pop()
+            if V_i in reached or V_i not in inputs:
+                continue
+            reached.add(V_i)
+            to_visit += [V_j for V_j in G.ch(V_i) if V_j in position]
+        dependents[k] = sorted(reached, key=position.get)
+
+    marginals = marginal_probabilities(P_U, U, D)
+    if marginals is not None:
+        marginals = [marginal.tolist() for marginal in marginals]
+
+    def resync():
+        # the product of the marginals, kept as the number of zero factors and the product of the others
+        factors = [marginal[i] for marginal, i in zip(marginals, index)]
+        return sum(factor == 0 for factor in factors), float(np.prod([factor for factor in factors if factor != 0]))
+
+    prob_outcome = dict()
+    normalizer = 0
+    states = list()
+
+    def visit(p_u):
+        nonlocal normalizer
+        if skip_zero and p_u == 0:
+            return
+        if not all(assigned[V_i] == condition[V_i] for V_i in condition):
+            return
+        normalizer += p_u
+        key = tuple(assigned[V_i] for V_i in outcome)
+        prob_outcome[key] = prob_outcome.get(key, 0) + p_u
+        if keep_states:
+            states.append({V_i: assigned[V_i] for V_i in V_ordered})
+
+    for V_i in V_ordered:
+        assigned[V_i] = intervention[V_i] if V_i in intervention else F[V_i](assigned)
+    zeros, product_nonzero = resync() if marginals is not None else (0, 1.0)
+    visit(P_U(assigned) if marginals is None else (0.0 if zeros else product_nonzero))
+
+    for step, (j, value) in enumerate(gray_code([len(domains[k]) for k in varying]), 1):
+        k = varying[j]
+        if marginals is not None:
+            old, new = marginals[k][index[k]], marginals[k][value]
+            zeros += (new == 0) - (old == 0)
+            product_nonzero = product_nonzero * (new if new != 0 else 1) / (old if old != 0 else 1)
+        index[k] = value
+        assigned[U[k]] = domains[k][value]
+        for V_i in dependents[k]:
+            assigned[V_i] = F[V_i](assigned)
+        if marginals is None:
+            visit(P_U(assigned))
+            continue
+        if step % GRAY_RESYNC == 0:
+            zeros, product_nonzero = resync()
+        visit(0.0 if zeros else product_nonzero)
+
+    return prob_outcome, normalizer, states
@@ -0,0 +1,114 @@
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+
+""" Materialized joint distributions of the endogenous variables, from which queries are answered by slicing """
+
+JOINT_CACHE_BYTES = 1 << 26  # default bound on the memory of the joint distributions cached by a model
+JOINT_ENUMERATION_LIMIT = 1 << 12  # materializing a joint then costs about as much as a few queries
+
+
+class JointDistribution:
+    """
+    Dense (unnormalized) joint distribution of the endogenous variables under an intervention.
+
+    Parameters
+    ----------
+    variables : Sequence[str]
+        Endogenous variables, one axis of table each
+    domains : Sequence[np.ndarray]
+        Values of each variable, along its axis
+    table : np.ndarray
+        Probability mass of each joint value
+    """
+
+    def __init__(self, variables: Sequence[str], domains: Sequence[np.ndarray], table: np.ndarray):
+        self.variables = tuple(variables)
+        self.position = {V_i: k for k, V_i in enumerate(self.variables)}
+        self.domains = [np.asarray(domain) for domain in domains]
+        self.table = table
+        self._values = [domain.tolist() for domain in self.domains]  # as Python values, for the outcome keys
+
+    @staticmethod
+    def from_masses(
+        variables: Sequence[str], masses: Dict[tuple, float], max_bytes: int = None
+    ) -> Optional["JointDistribution"]:
+        """The joint distribution of the masses of joint values (as the outcome masses of _enumerate over all
+        variables), None if its table would take more than max_bytes"""
+        keys = list(masses)
+        domains = [np.array(sorted({key[k] for key in keys})) for k in range(len(variables))]
+        shape = tuple(len(domain) for domain in domains)
+        if max_bytes is not None and int(np.prod(shape, dtype=float)) * 8 > max_bytes:
+            return None
+        table = np.zeros(shape)
+        if keys:
+            index = tuple(np.searchsorted(domain, [key[k] for key in keys]) for k, domain in enumerate(domains))
+            table[index] = list(masses.values())
+        return JointDistribution(variables, domains, table)
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes + sum(domain.nbytes for domain in self.domains)
+
+    def query(self, outcome: Tuple, condition: dict) -> Tuple[Dict[tuple, float], float]:
+        """ Unnormalized P(outcome, condition) and P(condition), as _enumerate, by slicing and summing the table """
+        index = [slice(None)] * len(self.variables)
+        offsets = [0] * len(self.variables)  # of the values left on each axis, in its domain
+        for V_i, value in condition.items():
+            k = self.position[V_i]
+            hits = np.flatnonzero(self.domains[k] == value)
+            if not len(hits):
+                return dict(), 0.0
+            index[k], offsets[k] = slice(hits[0], hits[0] + 1), hits[0]
+        table = self.table[tuple(index)]
+
+        kept = sorted({self.position[V_i] for V_i in outcome})
+        marginal = table.sum(axis=tuple(k for k in range(len(self.variables)) if k not in kept))
+        prob_outcome = dict()
+        for values in zip(*np.nonzero(marginal)):
+            assigned = {k: self._values[k][offsets[k] + i] for k, i in zip(kept, values)}
+            prob_outcome[tuple(assigned[self.position[V_i]] for V_i in outcome)] = float(marginal[values])
+        return prob_outcome, float(table.sum())
+
+
+class JointCache:
+    """
+    Least recently used joint distributions, per intervention, within a bound on their total memory.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Bound on the total nbytes of the cached joint distributions, zero disables the cache
+    """
+
+    def __init__(self, max_bytes: int = JOINT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._joints = OrderedDict()
+
+    def __len__(self):
+        return len(self._joints)
+
+    def __contains__(self, key):
+        return key in self._joints
+
+    def get(self, key) -> Optional[JointDistribution]:
+        if key not in self._joints:
+            return None
+        self._joints.move_to_end(key)
+        return self._joints[key]
+
+    def put(self, key, joint: JointDistribution):
+        """ Cache joint, evicting the least recently used ones to make room (if it fits at all) """
+        if joint.nbytes > self.max_bytes:
+            return
+        if key in self._joints:
+            self.nbytes -= self._joints.pop(key).nbytes
+        while self.nbytes + joint.nbytes > self.max_bytes:
+            self.nbytes -= self._joints.popitem(last=False)[1].nbytes
+        self._joints[key] = joint
+        self.nbytes += joint.nbytes
+
+    def clear(self):
+        self._joints.clear()
+        self.nbytes = 0
@@ -1,13 +1,29 @@
 import itertools
 from collections import defaultdict
-from itertools import product
 import functools
 import networkx as nx
 import numpy as np
 from typing import Dict, Iterable, Optional, Set, Sequence, AbstractSet
 from typing import FrozenSet, Tuple
+from scm_mab.compiled import compiled_equations
+from scm_mab.elimination import elimination_query
+from scm_mab.gf2 import parity_expectations, parity_query
+from scm_mab.joint import JOINT_CACHE_BYTES, JOINT_ENUMERATION_LIMIT, JointCache, JointDistribution
+from scm_mab.montecarlo import MONTE_CARLO_WIDTH, MonteCarloEstimate, monte_carlo_query, sample_U
+from scm_mab.parallel import get_trial_pool, parallel_expectations, parallel_query
+from scm_mab.propagation import SlicePropagation
+from scm_mab.inference import (
+    ancestral_closure,
+    gray_query,
+    loop_query,
+    marginal_probabilities,
+    solve,
+    static_equations,
+    vectorized_expectations,
+    vectorized_query,
+)
 from scm_mab.utils import fzset_union, sortup, sortup2, with_default
-from src.utils.my_utils import remove_duplicate_dicts, remove_exo
+from src.utils.my_utils import remove_duplicate_dicts
 
 
 def default_P_U(mu: Dict):
@@ -19,6 +35,7 @@ def default_P_U(mu: Dict):
             p_val *= (1 - mu[k]) if d[k] == 0 else mu[k]
         return p_val
 
+    P_U.mu = mu  # product form, which lets the vectorized engine use per-variable probability vectors
     return P_U
 
 
@@ -448,26 +465,114 @@ class CausalDiagram:
             return f"[" + (", ".join(paths_string) + " / " + ", ".join(bipaths_string)) + "]"
 
 
+def query_engines():
+    return ["loop", "gray", "vectorized", "elimination"]
+
+
 class StructuralCausalModel:
-    def __init__(self, G: CausalDiagram, F=None, P_U=None, D=None, more_U=None):
+    def __init__(
+        self,
+        G: CausalDiagram,
+        F=None,
+        P_U=None,
+        D=None,
+        more_U=None,
+        engine="vectorized",
+        closed_form=True,
+        compiled=True,
+        joint_cache_bytes=JOINT_CACHE_BYTES,
+        n_jobs=None,
+    ):
         self.G = G
         self.F = F  # SEM
         self.P_U = P_U
         self.D = with_default(D, defaultdict(lambda: (0, 1)))
         self.more_U = set() if more_U is None else set(more_U)
+        assert engine in query_engines()
+        self.engine = engine  # "vectorized" enumerates U with arrays (scm_mab.inference), "elimination" sums it out
+        self.closed_form = closed_form  # answer queries on XOR-affine equations in closed form, see scm_mab.gf2
+        self.compiled = compiled  # evaluate the equations by table lookups, see scm_mab.compiled
+        self._compiled = dict()  # compiled equations of a SEM which cannot be cached per SEM object
+        self.joints = JointCache(joint_cache_bytes)  # per intervention, from which query00 slices its answers
+        self._unmaterialized = set()  # interventions whose joint is too large to be cached
+        self._queried = set()  # interventions queried once, whose joint is materialized on their next query
+        self.n_jobs = n_jobs  # workers of the vectorized queries and expectations, None enumerates in this process
         self.query00 = functools.lru_cache(1024)(self.query00)
 
+    def equations(self, past_assigned: dict = None) -> dict:
+        """The structural equations of the first time-slice, or of a later one starting from the values past_assigned
+        of the previous time-slice, compiled (and cached) unless compiled is False"""
+        if self.compiled:
+            U = list(sorted(self.G.U | self.more_U))
+            return compiled_equations(self.F, self.G, U, self.D, past_assigned, self._compiled)
+        return static_equations(self.F) if past_assigned is None else self.F.dynamic(past_assigned)
+
+    def sample(self, n_samples: int, intervention: dict = None, seed=None) -> Dict[str, np.ndarray]:
+        """Values of U and V in n_samples draws of the first time-slice under intervention, U being drawn from the
+        marginals of P_U (which has to be of product form, as made by default_P_U)"""
+        U = list(sorted(self.G.U | self.more_U))
+        marginals = marginal_probabilities(self.P_U, U, self.D)
+        assert marginals is not None, "sampling requires a P_U of product form"
+        assigned = sample_U(marginals, U, self.D, n_samples, np.random.default_rng(seed))
+        return solve(self.equations(), self.G.causal_order(), with_default(intervention, dict()), assigned, n_samples)
+
+    def _enumerate(self, F, outcome, condition, intervention, skip_zero=True, keep_states=False, closed_form=None):
+        """Unnormalized outcome distribution, normalizer and reached states (keep_states), see vectorized_query.
+
+        Unless the states are kept, the vectorized engine only enumerates the ancestral closure of the outcome and
+        condition variables in the intervened graph. The elimination engine sums out the background variables of that
+        closure by variable elimination (see scm_mab.elimination), and enumerates them as the vectorized engine when
+        the states are kept. With closed_form, both first try the parity formulas of scm_mab.gf2, which apply when the
+        equations of the closure are XOR-affine and U is binary of product form. The gray engine is the loop engine
+        walking U in Gray code order, see gray_query. Given n_jobs, the vectorized enumeration is split into blocks
+        enumerated by a process pool, whose result does not depend on n_jobs. closed_form overrides the model's.
+        """
+        U = list(sorted(self.G.U | self.more_U))  # This | is the set union operator.
+        if self.engine == "loop":
+            return loop_query(
+                F, self.G.causal_order(), U, self.D, self.P_U, outcome, condition, intervention, skip_zero, keep_states
+            )
+        if self.engine == "gray":
+            V_ordered = self.G.causal_order()
+            return gray_query(
+                F, self.G, V_ordered, U, self.D, self.P_U, outcome, condition, intervention, skip_zero, keep_states
+            )
+        if with_default(closed_form, self.closed_form) and not keep_states:
+            result = parity_query(F, self.G, U, self.D, self.P_U, outcome, condition, intervention)
+            if result is not None:
+                return result
+        if self.engine == "elimination" and not keep_states:
+            return elimination_query(F, self.G, U, self.D, self.P_U, outcome, condition, intervention)
+
+        V_ordered, scale = self.G.causal_order(), 1.0
+        if not keep_states:
+            targets = list(outcome) + list(condition)
+            V_ordered, U, scale = ancestral_closure(F, self.G, U, self.D, self.P_U, targets, intervention)
+        arguments = F, V_ordered, U, self.D, self.P_U, outcome, condition, intervention, skip_zero, keep_states
+        if self.n_jobs is not None:
+            prob_outcome, normalizer, states = parallel_query(get_trial_pool(self.n_jobs), *arguments)
+        else:
+            prob_outcome, normalizer, states = vectorized_query(*arguments)
+        return {key: p * scale for key, p in prob_outcome.items()}, normalizer * scale, states
+
     def query(
         self,
         outcome: Tuple,
         condition: dict = None,
         intervention: dict = None,
         verbose=False,
+        approximate=False,
+        width: float = MONTE_CARLO_WIDTH,
+        seed=None,
     ) -> defaultdict:
+        """P(outcome | condition) under intervention, exactly or, if approximate, as the MonteCarloEstimate of
+        monte_carlo_query"""
         if condition is None:
             condition = dict()
         if intervention is None:
             intervention = dict()
+        if approximate:
+            return self.monte_carlo_query(outcome, condition, intervention, width, seed)
         new_condition = tuple(sorted([(x, y) for x, y in condition.items()]))
         new_intervention = tuple(sorted([(x, y) for x, y in intervention.items()]))
 
@@ -477,35 +582,18 @@ class StructuralCausalModel:
 
         condition = dict(condition)
         intervention = dict(intervention)
-        prob_outcome = defaultdict(lambda: 0)
-        U = list(sorted(self.G.U | self.more_U))  # This | is the set union operator.
-        D = self.D  # Intervention domain
-        P_U = self.P_U
-        V_ordered = self.G.causal_order()
         if verbose:
-            print(f"ORDER: {V_ordered}")
-        normalizer = 0
+            print(f"ORDER: {self.G.causal_order()}")
 
-        #  XXX: my addition to be able to use same function
-        F = self.F.static()
+        #  XXX: my addition to be able to use same function
+        F = self.equations()
 
         # Multivariate domain found on the fly
-        for u in product(*[D[U_i] for U_i in U]):  # d^|U|
-            assigned = dict(zip(U, u))
-            p_u = P_U(assigned)
-            if p_u == 0:
-                continue
-            # evaluate values -- note that self.F has the causal order as well
-            for V_i in V_ordered:
-                if V_i in intervention:
-                    assigned[V_i] = intervention[V_i]
-                else:
-                    assigned[V_i] = F[V_i](assigned)
-
-            if not all(assigned[V_i] == condition[V_i] for V_i in condition):
-                continue
-            normalizer += p_u
-            prob_outcome[tuple(assigned[V_i] for V_i in outcome)] += p_u
+        joint = self.joint(F, outcome, condition, intervention)
+        if joint is not None:
+            prob_outcome, normalizer = joint.query(outcome, condition)
+        else:
+            prob_outcome, normalizer, _ = self._enumerate(F, outcome, condition, intervention)
 
         if prob_outcome:
             # normalize by prob condition
@@ -513,6 +601,59 @@ class StructuralCausalModel:
         else:
             return defaultdict(lambda: np.nan)  # nan or 0?
 
+    def monte_carlo_query(
+        self,
+        outcome: Tuple,
+        condition: dict = None,
+        intervention: dict = None,
+        width: float = MONTE_CARLO_WIDTH,
+        seed=None,
+        likelihood_weighting=True,
+    ) -> MonteCarloEstimate:
+        """query estimated from batches of (likelihood weighted) samples of U, until the confidence intervals of the
+        outcome probabilities are at most width wide, for models whose U is too large to enumerate (see
+        scm_mab.montecarlo)"""
+        U = list(sorted(self.G.U | self.more_U))
+        condition, intervention = with_default(condition, dict()), with_default(intervention, dict())
+        F = self.equations()
+        estimate = monte_carlo_query(
+            F, self.G, U, self.D, self.P_U, outcome, condition, intervention, width, seed, likelihood_weighting
+        )
+        assert estimate is not None, "sampling requires a P_U of product form"
+        return estimate
+
+    def joint(self, F: dict, outcome: Tuple, condition: dict, intervention: dict) -> Optional[JointDistribution]:
+        """The joint distribution of the endogenous variables under intervention, from which query00 answers the
+        queries of that intervention after its first, kept in joints.
+
+        The first query of an intervention is answered by _enumerate as usual, a later one materializes the joint with
+        the model's engine (but not in closed form, which would build tensors over all of V). None if the outcome or
+        condition names a background variable, if the joints are disabled, if the table estimated from the domains of V
+        would not fit in the cache or if U has more than JOINT_ENUMERATION_LIMIT configurations."""
+        key = tuple(sorted(intervention.items()))
+        if not set(outcome) | set(condition) <= self.G.V:
+            return None
+        joint = self.joints.get(key)
+        if joint is not None or not self.joints.max_bytes or key in self._unmaterialized:
+            return joint
+        if key not in self._queried:
+            self._queried.add(key)
+            return None
+
+        U = list(sorted(self.G.U | self.more_U))
+        V_ordered = tuple(self.G.causal_order())
+        n_entries = np.prod([len(self.D[V_i]) for V_i in V_ordered], dtype=float)
+        n_configurations = np.prod([len(self.D[U_i]) for U_i in U], dtype=float)
+        fits = n_entries * np.dtype(float).itemsize <= self.joints.max_bytes
+        if fits and n_configurations <= JOINT_ENUMERATION_LIMIT:
+            masses, _, _ = self._enumerate(F, V_ordered, dict(), intervention, closed_form=False)
+            joint = JointDistribution.from_masses(V_ordered, masses, self.joints.max_bytes)
+        if joint is None:
+            self._unmaterialized.add(key)
+        else:
+            self.joints.put(key, joint)
+        return joint
+
     def new_query(
         self,
         outcome: Tuple,
@@ -529,67 +670,89 @@ class StructuralCausalModel:
     def query01(self, outcome: Tuple, condition: Tuple, interventions: list, verbose=False) -> defaultdict:
         """Finds expectation after a sequence of interventions."""
         condition = dict(condition)
-        U = list(sorted(self.G.U | self.more_U))
-        D = self.D
-        P_U = self.P_U
         self.V_ordered = self.G.causal_order()
         if verbose is True:
             print(f"ORDER: {self.V_ordered}")
 
+        prob_outcome, normalizer, _ = self._slices(outcome, condition, interventions, verbose=verbose)
+
+        if prob_outcome:
+            # normalize by prob condition
+            return defaultdict(lambda: 0, {k: v / normalizer for k, v in prob_outcome.items()})
+        else:
+            return defaultdict(lambda: np.nan)  # nan or 0?
+
+    def _slices(self, outcome: Tuple, condition: dict, interventions: list, verbose=False):
+        """The pass of query01 over a sequence of interventions, one per time-slice.
+
+        Returns the outcome masses and normalizer accumulated over all time-slices.
+        """
         T = len(interventions)
-        assign_store = {t: [] for t in range(T)}
+        normalizer = 0
+        prob_outcome = defaultdict(lambda: 0)
+        states = []
 
         for t, intervention in enumerate(interventions):
             if verbose:
                 print("\n >>>", t, intervention)
 
             if t == 0:
-                normalizer = 0
-                prob_outcome = defaultdict(lambda: 0)
-                F = self.F.static()
-
-                for u in product(*[D[U_i] for U_i in U]):  # d^|U|
-
-                    assigned = dict(zip(U, u))
-                    p_u = P_U(assigned)
-                    assigned = self._assign(assigned, intervention, F)
-                    if not all(assigned[V_i] == condition[V_i] for V_i in condition):
-                        continue
-                    normalizer += p_u
-                    prob_outcome[tuple(assigned[V_i] for V_i in outcome)] += p_u
-
-                    if T > 1:
-                        #  Only passing forward manipulative and reward variables, no exogenous
-                        assign_store[t].append(remove_exo(self.V_ordered, assigned))
-
+                Fs = [self.equations()]
             else:
-                # normalizer = 0
-                past_assignees = remove_duplicate_dicts(assign_store[t - 1])
-                for past_assigned in past_assignees:
-                    # TODO: not clear if should set to zero here
-                    # normalizer = 0
-                    # prob_outcome = defaultdict(lambda: 0)
-                    F = self.F.dynamic(past_assigned)
-
-                    for u in product(*[D[U_i] for U_i in U]):
-
-                        assigned = dict(zip(U, u))
-                        p_u = P_U(assigned)
-                        assigned = self._assign(assigned, intervention, F)
-                        if not all(assigned[V_i] == condition[V_i] for V_i in condition):
-                            continue
-                        normalizer += p_u
-                        prob_outcome[tuple(assigned[V_i] for V_i in outcome)] += p_u
-
-                        if T - 1 != t:
-                            # Only passing forward manipulative and reward variables, no exogenous
-                            assign_store[t].append(remove_exo(self.V_ordered, assigned))
-
-        if prob_outcome:
-            # normalize by prob condition
-            return defaultdict(lambda: 0, {k: v / normalizer for k, v in prob_outcome.items()})
-        else:
-            return defaultdict(lambda: np.nan)  # nan or 0?
+                # TODO: not clear if should set to zero here
+                Fs = [self.equations(past_assigned) for past_assigned in remove_duplicate_dicts(states)]
+
+            states = []
+            for F in Fs:
+                # Only passing forward manipulative and reward variables, no exogenous
+                slice_outcome, slice_normalizer, reached = self._enumerate(
+                    F, outcome, condition, intervention, skip_zero=False, keep_states=T - 1 != t
+                )
+                normalizer += slice_normalizer
+                for key, p in slice_outcome.items():
+                    prob_outcome[key] += p
+                states += reached
+
+        return prob_outcome, normalizer, states
+
+    def expectations(self, reward_variable: str, arms: Sequence[dict], past_interventions: list = None) -> np.ndarray:
+        """Expected reward of every arm (an intervention) in one pass, as query (or new_query after past_interventions)
+        of each arm would give.
+
+        The enumeration of U, P(u) and the variables which do not descend from an arm's intervention are shared by all
+        arms, see vectorized_expectations, and split into blocks enumerated by a process pool given n_jobs. The other
+        engines answer one query per arm instead.
+        """
+        D_Y = self.D[reward_variable]
+        if self.engine != "vectorized":
+            results = [
+                self.new_query((reward_variable,), interventions=past_interventions + [arm])
+                if past_interventions
+                else self.query((reward_variable,), intervention=arm)
+                for arm in arms
+            ]
+            return np.array([sum(y_val * result[(y_val,)] for y_val in D_Y) for result in results])
+
+        # the time-slices before the arm's are the same for all arms
+        propagation = SlicePropagation(reward_variable)
+        for intervention in with_default(past_interventions, []):
+            propagation.advance(self, intervention)
+        return propagation.expectations(self, arms)
+
+    def arm_masses(
+        self, F: dict, reward_variable: str, arms: Sequence[dict], skip_zero=True
+    ) -> Tuple[np.ndarray, float]:
+        """ Unnormalized expected reward of every arm under the equations F and the normalizer, see expectations """
+        U = list(sorted(self.G.U | self.more_U))
+        result = None
+        if self.closed_form:
+            result = parity_expectations(F, self.G, U, self.D, self.P_U, reward_variable, arms)
+        if result is None and self.n_jobs is not None:
+            pool = get_trial_pool(self.n_jobs)
+            result = parallel_expectations(pool, F, self.G, U, self.D, self.P_U, reward_variable, arms, skip_zero)
+        if result is None:
+            result = vectorized_expectations(F, self.G, U, self.D, self.P_U, reward_variable, arms, skip_zero)
+        return result
 
     def _assign(self, assigned, intervention, F):
         for V_i in self.V_ordered:
@@ -0,0 +1,185 @@
+import numpy as np
+from collections import defaultdict
+from functools import reduce
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from scm_mab.inference import ancestral_closure, enumerate_U, equation_inputs, evaluate, marginal_probabilities
+
+""" Approximate inference on structural causal models too large to enumerate, by sampling the background variables """
+
+MONTE_CARLO_WIDTH = 0.01  # sampling stops once the confidence intervals of all outcome probabilities are this narrow
+MONTE_CARLO_Z = 1.96  # standard errors on each side of the estimate, i.e. 95% confidence intervals
+MONTE_CARLO_BATCH = 1 << 14  # background configurations drawn and solved at once
+MONTE_CARLO_MAX_SAMPLES = 1 << 22  # sampling stops there even if the intervals are wider than asked for
+NOISE_ENUMERATION_LIMIT = 1 << 8  # largest private noise space summed out to weigh a conditioned variable
+
+
+class MonteCarloEstimate(defaultdict):
+    """
+    Outcome distribution estimated from (weighted) samples, as query returns it, with the standard error of every
+    probability.
+
+    Parameters
+    ----------
+    probabilities : Dict[tuple, float]
+        Estimated probability of each outcome which was sampled
+    standard_errors : Dict[tuple, float]
+        Standard error of each estimated probability
+    n_samples : int
+        Samples drawn
+    n_accepted : int
+        Samples of nonzero weight, i.e. which met the condition (all estimates are nan if there are none)
+    effective_sample_size : float
+        Number of unweighted samples the weighted ones are worth, (sum of weights)^2 / sum of squared weights
+    """
+
+    def __init__(
+        self,
+        probabilities: Dict[tuple, float],
+        standard_errors: Dict[tuple, float],
+        n_samples: int,
+        n_accepted: int,
+        effective_sample_size: float,
+    ):
+        super().__init__((lambda: 0) if n_accepted else (lambda: np.nan), probabilities)
+        self.standard_errors = standard_errors
+        self.n_samples = n_samples
+        self.n_accepted = n_accepted
+        self.effective_sample_size = effective_sample_size
+
+
+def sample_U(marginals: List[np.ndarray], U: Sequence[str], D, n: int, rng: np.random.Generator) -> dict:
+    """n draws of each background variable from its (unnormalized) marginal, in the style of
+    sample_binary_exogenous_and_confounders"""
+    return {
+        U_i: rng.choice(np.asarray(D[U_i]), size=n, p=marginal / marginal.sum()) for U_i, marginal in zip(U, marginals)
+    }
+
+
+class WeightedCounts:
+    """ Sums of the weights, and of the squared weights, of all samples and of those of each outcome """
+
+    def __init__(self):
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.outcomes = defaultdict(lambda: np.zeros((2,)))
+
+    def add(self, keys: np.ndarray, weights: np.ndarray):
+        """ Count samples of outcomes keys (one row per sample) and weights """
+        self.total += float(weights.sum())
+        self.total_squares += float(np.dot(weights, weights))
+        outcomes, inverse = np.unique(keys, axis=0, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=weights, minlength=len(outcomes))
+        sums_squares = np.bincount(inverse.ravel(), weights=weights**2, minlength=len(outcomes))
+        for key, w, w2 in zip(map(tuple, outcomes.tolist()), sums.tolist(), sums_squares.tolist()):
+            self.outcomes[key] += w, w2
+
+    def probabilities(self) -> Dict[tuple, float]:
+        return {key: float(w / self.total) for key, (w, _) in self.outcomes.items()}
+
+    def standard_errors(self) -> Dict[tuple, float]:
+        """Delta method standard error of each self-normalized estimate, sqrt(sum w^2 (1[key] - p)^2) / sum w, which
+        is sqrt(p (1 - p) / n) for unit weights"""
+        errors = dict()
+        for key, (w, w2) in self.outcomes.items():
+            p = w / self.total
+            errors[key] = float(np.sqrt(w2 * (1 - p) ** 2 + (self.total_squares - w2) * p**2) / self.total)
+        return errors
+
+    def effective_sample_size(self) -> float:
+        return self.total**2 / self.total_squares if self.total_squares else 0.0
+
+
+def private_noise(F: dict, G, U: Sequence[str], D, V_ordered: Sequence[str], intervention: dict) -> Dict[str, list]:
+    """The background variables which, among V_ordered (not intervened on), only the equation of each variable reads"""
+    inputs = {V_i: equation_inputs(F, G, V_i, U, D) for V_i in V_ordered if V_i not in intervention}
+    readers = defaultdict(int)
+    for V_i_inputs in inputs.values():
+        for name in V_i_inputs:
+            readers[name] += 1
+    return {V_i: [U_i for U_i in U if U_i in V_i_inputs and readers[U_i] == 1] for V_i, V_i_inputs in inputs.items()}
+
+
+def likelihood(f: Callable, value, noise: Sequence[str], marginals: List[np.ndarray], D, assigned: dict, n: int):
+    """P(f = value) given the other inputs of the n samples of assigned, summing out the private noise of f (of
+    marginals, in the order of noise)"""
+    weights = reduce(np.multiply.outer, [marginal / marginal.sum() for marginal in marginals]).ravel()
+    configurations = enumerate_U(noise, D, 0, len(weights))
+    result = np.zeros((n,))
+    for k, weight in enumerate(weights.tolist()):
+        if weight:
+            noise_values = {U_i: np.full((n,), configurations[U_i][k]) for U_i in noise}
+            result += weight * (evaluate(f, {**assigned, **noise_values}, n) == value)
+    return result
+
+
+def monte_carlo_query(
+    F: dict,
+    G,
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    outcome: Tuple,
+    condition: dict,
+    intervention: dict,
+    width: float = MONTE_CARLO_WIDTH,
+    seed=None,
+    likelihood_weighting=True,
+    batch_size: int = MONTE_CARLO_BATCH,
+    max_samples: int = MONTE_CARLO_MAX_SAMPLES,
+) -> Optional[MonteCarloEstimate]:
+    """P(outcome | condition) under intervention estimated by drawing batches of background configurations, None
+    unless P_U is of product form.
+
+    Only the background variables of the ancestral closure of the outcome and condition variables are drawn. With
+    likelihood_weighting, a conditioned variable with private noise (background variables no other equation reads, of
+    at most NOISE_ENUMERATION_LIMIT configurations) is set to its conditioned value and each sample is weighed by the
+    probability of that value, the noise being summed out instead of drawn. Samples which disagree with the other
+    conditioned variables are rejected, as soon as each is assigned in causal order.
+
+    Sampling stops after the first batch whose confidence intervals (MONTE_CARLO_Z standard errors on each side) on all
+    outcome probabilities are at most width wide, or after max_samples.
+    """
+    marginals = marginal_probabilities(P_U, U, D)
+    if marginals is None:
+        return None
+    marginals = dict(zip(U, marginals))
+    V_ordered, U_relevant, _ = ancestral_closure(F, G, U, D, P_U, list(outcome) + list(condition), intervention)
+    weighted = dict()  # conditioned variable -> its private noise
+    if likelihood_weighting:
+        for V_i, noise in private_noise(F, G, U_relevant, D, V_ordered, intervention).items():
+            if V_i in condition and noise and np.prod([len(D[U_i]) for U_i in noise]) <= NOISE_ENUMERATION_LIMIT:
+                weighted[V_i] = noise
+    summed_out = {U_i for noise in weighted.values() for U_i in noise}
+    U_drawn = [U_i for U_i in U_relevant if U_i not in summed_out]
+    rng = np.random.default_rng(seed)
+
+    counts, n_samples, n_accepted = WeightedCounts(), 0, 0
+    while n_samples < max_samples:
+        n = min(batch_size, max_samples - n_samples)
+        assigned = sample_U([marginals[U_i] for U_i in U_drawn], U_drawn, D, n, rng)
+        weights = np.ones((n,))
+        for V_i in V_ordered:
+            if V_i in intervention:
+                assigned[V_i] = np.full((len(weights),), intervention[V_i])
+            elif V_i in weighted:
+                noise = weighted[V_i]
+                f, value, noise_marginals = F[V_i], condition[V_i], [marginals[U_i] for U_i in noise]
+                weights = weights * likelihood(f, value, noise, noise_marginals, D, assigned, len(weights))
+                assigned[V_i] = np.full((len(weights),), value)
+            else:
+                assigned[V_i] = evaluate(F[V_i], assigned, len(weights))
+            if V_i in condition:
+                kept = (weights > 0) & (assigned[V_i] == condition[V_i])
+                if not kept.all():
+                    assigned, weights = {key: values[kept] for key, values in assigned.items()}, weights[kept]
+        counts.add(np.stack([assigned[V_i] for V_i in outcome], axis=1), weights)
+        n_samples, n_accepted = n_samples + n, n_accepted + len(weights)
+        if n_accepted and 2 * MONTE_CARLO_Z * max(counts.standard_errors().values()) <= width:
+            break
+
+    if not n_accepted:
+        return MonteCarloEstimate(dict(), dict(), n_samples, n_accepted, 0.0)
+    return MonteCarloEstimate(
+        counts.probabilities(), counts.standard_errors(), n_samples, n_accepted, counts.effective_sample_size()
+    )
@@ -0,0 +1,333 @@
+import atexit
+import numpy as np
+import os
+import shutil
+import tempfile
+from joblib import Parallel, delayed, effective_n_jobs
+from tqdm import tqdm
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from scm_mab.history import TrialAggregate
+from scm_mab.inference import ENUMERATION_CHUNK, _enumeration, _expectations, ancestral_closure, arm_descendants
+from scm_mab.utils import arm_dtype
+
+PARALLEL_BLOCK = 1 << 20  # U configurations per block of parallel_query, independent of the number of workers
+
+
+def trial_mu(mu, i: int):
+    """ The expected rewards of the i-th trial, mu being shared by all trials (K,) or given per trial (n_trials, K) """
+    return mu[i] if np.ndim(mu) == 2 else mu
+
+
+def chunk_mu(mu, start: int, stop: int):
+    """ The expected rewards of trials start, ..., stop - 1, see trial_mu """
+    return np.asarray(mu)[start:stop] if np.ndim(mu) == 2 else mu
+
+
+def play_chunk(algorithm: Callable, T: int, mu, seeds: list, kwargs: dict, start: int, arms_out, rewards_out):
+    """Play one trial per seed and write them into rows start, start + 1, ... of the (shared) output arrays.
+
+    T, mu (the chunk's, see chunk_mu) and kwargs are shipped once for the whole chunk.
+    """
+    for i, seed in enumerate(seeds):
+        arms_out[start + i], rewards_out[start + i] = algorithm(T, trial_mu(mu, i), seed=seed, **kwargs)
+
+
+def aggregate_chunk(algorithm: Callable, T: int, mu, seeds: list, kwargs: dict, mu_star=None) -> TrialAggregate:
+    """ Play one trial per seed and fold each into a TrialAggregate as soon as it is played """
+    aggregate = TrialAggregate(T, mu, mu_star)
+    for i, seed in enumerate(seeds):
+        aggregate.add(*algorithm(T, trial_mu(mu, i), seed=seed, **kwargs), mu=trial_mu(mu, i))
+    return aggregate
+
+
+class TrialPool:
+    """
+    Long-lived joblib worker pool which plays bandit trials in chunks.
+
+    The workers are kept alive between calls (e.g. across the time-slices of CCB) and trials are split into a few
+    contiguous chunks per worker, so that the arguments of a run are pickled once per chunk instead of once per trial.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of workers, as in joblib
+    backend : str
+        joblib backend, e.g. "loky" (processes) or "threading"
+    chunks_per_worker : int
+        Number of chunks per worker, more chunks balance the load better at a higher dispatch cost
+    progress : bool
+        Show a progress bar (on stderr) which is updated once per chunk
+    """
+
+    def __init__(self, n_jobs=1, backend="loky", chunks_per_worker=4, progress=False):
+        self.n_jobs = effective_n_jobs(n_jobs)
+        self.backend = backend
+        self.chunks_per_worker = chunks_per_worker
+        self.progress = progress
+        self._parallel = None
+        self._temp_folders = dict()  # whether in /dev/shm -> folder of the memory mapped outputs
+
+    def __enter__(self) -> "TrialPool":
+        self.open()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def open(self):
+        if self._parallel is None:
+            self._parallel = Parallel(n_jobs=self.n_jobs, backend=self.backend, verbose=0, return_as="generator")
+            self._parallel.__enter__()
+
+    def close(self):
+        if self._parallel is not None:
+            self._parallel.__exit__(None, None, None)
+            self._parallel = None
+        for folder in self._temp_folders.values():
+            shutil.rmtree(folder, ignore_errors=True)
+        self._temp_folders.clear()
+
+    @property
+    def shares_memory(self) -> bool:
+        """ Whether workers see the arrays of this process, otherwise outputs have to be memory mapped """
+        return self.n_jobs == 1 or self.backend == "threading"
+
+    def allocate(self, shape: Tuple[int, ...], dtype) -> np.ndarray:
+        """A zeroed output array that workers can write into, without copies.
+
+        For process based backends it is backed by a file which joblib hands over to the workers as a memory map. The
+        file is in /dev/shm if it has room for this array (checked on every allocation) and in the temp folder
+        otherwise. Its pages are reserved up front where posix_fallocate is available, so that a full /dev/shm makes
+        the allocation fall back to the temp folder instead of crashing the workers (SIGBUS) once they write.
+        """
+        if self.shares_memory:
+            return np.zeros(shape, dtype=dtype)
+
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free > 2 * nbytes:
+            filename = self._reserve(True, nbytes)
+            if filename is not None:
+                return np.memmap(filename, dtype=dtype, mode="r+" if nbytes else "w+", shape=shape)
+        filename = self._reserve(False, nbytes)
+        return np.memmap(filename, dtype=dtype, mode="r+" if nbytes else "w+", shape=shape)
+
+    def _reserve(self, in_shm: bool, nbytes: int) -> Optional[str]:
+        """ A new file of nbytes (zeros) in /dev/shm or the temp folder, None if /dev/shm is out of space """
+        if in_shm not in self._temp_folders:
+            self._temp_folders[in_shm] = tempfile.mkdtemp(prefix="trial_pool_", dir="/dev/shm" if in_shm else None)
+        handle, filename = tempfile.mkstemp(suffix=".mmap", dir=self._temp_folders[in_shm])
+        try:
+            if nbytes and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(handle, 0, nbytes)
+            else:
+                os.ftruncate(handle, nbytes)
+        except OSError:
+            os.close(handle)
+            os.unlink(filename)
+            if in_shm:
+                return None
+            raise
+        os.close(handle)
+        return filename
+
+    @staticmethod
+    def release(array: np.ndarray):
+        """ Unlink the file behind a memory mapped output, the mapping of this process stays valid (on POSIX) """
+        if isinstance(array, np.memmap):
+            try:
+                os.unlink(array.filename)
+            except OSError:
+                pass  # e.g. still mapped on Windows, removed on close instead
+
+    def chunks(self, n_trials: int) -> List[Tuple[int, int]]:
+        """ Contiguous (start, stop) ranges of trial indices, a few per worker """
+        n_chunks = max(1, min(n_trials, self.n_jobs * self.chunks_per_worker))
+        bounds = np.linspace(0, n_trials, n_chunks + 1).round().astype(int).tolist()
+        return list(zip(bounds, bounds[1:]))
+
+    def run(self, function: Callable, tasks: List[tuple]) -> Iterator:
+        """ function(*task) of each task, evaluated by the workers and yielded in the order of tasks """
+        self.open()
+        return self._parallel(delayed(function)(*task) for task in tasks)
+
+    def play(self, algorithm: Callable, T: int, mu, seeds: list, out=None, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+        """Play one trial of algorithm per seed, row i of the results being the trial of seeds[i].
+
+        Workers write their trials straight into the (n_trials, T) output arrays, which are allocated with allocate
+        (with the smallest arm index type and one byte per Bernoulli reward) unless given as
+        out=(arms_selected, rewards).
+        """
+        self.open()
+        if out is None:
+            n_trials = len(seeds)
+            out = self.allocate((n_trials, T), arm_dtype(np.shape(mu)[-1])), self.allocate((n_trials, T), np.uint8)
+        arms_selected, rewards = out
+
+        chunks = self.chunks(len(seeds))
+        done = self._parallel(
+            delayed(play_chunk)(
+                algorithm, T, chunk_mu(mu, start, stop), seeds[start:stop], kwargs, start, arms_selected, rewards
+            )
+            for start, stop in chunks
+        )
+        for _ in tqdm(done, total=len(chunks), desc="Trial chunks", disable=not self.progress):
+            pass
+
+        self.release(arms_selected)
+        self.release(rewards)
+        return arms_selected, rewards
+
+    def aggregate(self, algorithm: Callable, T: int, mu, seeds: list, mu_star=None, **kwargs) -> TrialAggregate:
+        """Play one trial of algorithm per seed, keeping only their TrialAggregate.
+
+        Each worker folds the trials of its chunk and the chunk aggregates are merged in chunk order as they come back,
+        so that memory stays O(T + K) per worker whatever the number of trials.
+        """
+        self.open()
+        aggregate = TrialAggregate(T, mu, mu_star)
+        chunks = self.chunks(len(seeds))
+        done = self._parallel(
+            delayed(aggregate_chunk)(algorithm, T, chunk_mu(mu, start, stop), seeds[start:stop], kwargs, mu_star)
+            for start, stop in chunks
+        )
+        for chunk_aggregate in tqdm(done, total=len(chunks), desc="Trial chunks", disable=not self.progress):
+            aggregate.merge(chunk_aggregate)
+        return aggregate
+
+
+_shared_pools: Dict[Tuple[int, str, bool], TrialPool] = dict()
+
+
+def get_trial_pool(n_jobs=1, backend="loky", progress=False) -> TrialPool:
+    """ The pool shared by all callers asking for the same number of workers, backend and progress bar """
+    key = (effective_n_jobs(n_jobs), backend, progress)
+    if key not in _shared_pools:
+        _shared_pools[key] = TrialPool(key[0], backend, progress=progress)
+    return _shared_pools[key]
+
+
+@atexit.register
+def close_trial_pools():
+    for pool in _shared_pools.values():
+        pool.close()
+    _shared_pools.clear()
+
+
+def enumerate_blocks(
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D: dict,
+    P_U: Callable,
+    outcome: Tuple,
+    condition: dict,
+    intervention: dict,
+    skip_zero: bool,
+    keep_states: bool,
+    blocks: List[Tuple[int, int]],
+) -> list:
+    """ The partial outcome masses, normalizer and states of each (start, stop) block of U configurations """
+    return [
+        _enumeration(
+            F, V_ordered, U, D, P_U, outcome, condition, intervention, skip_zero, keep_states, ENUMERATION_CHUNK, *block
+        )
+        for block in blocks
+    ]
+
+
+def parallel_query(
+    pool: TrialPool,
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    outcome: Tuple,
+    condition: dict,
+    intervention: dict,
+    skip_zero=True,
+    keep_states=False,
+    block_size=PARALLEL_BLOCK,
+) -> Tuple[Dict[tuple, float], float, List[dict]]:
+    """vectorized_query with the mixed-radix range of U configurations split into contiguous blocks of block_size,
+    enumerated by the workers of pool.
+
+    Workers get a few contiguous runs of blocks each, along with the (compiled) equations, and return the partial
+    results of every block, which are reduced in block order. As the blocks do not depend on the workers, neither
+    does the result, to the last bit. A query of a single block is enumerated in this process.
+    """
+    D = {U_i: tuple(D[U_i]) for U_i in U}  # e.g. not a defaultdict of a lambda
+    n_configurations = int(np.prod([len(D[U_i]) for U_i in U]))
+    bounds = list(range(0, n_configurations, block_size)) + [n_configurations]
+    blocks = list(zip(bounds, bounds[1:]))
+    arguments = F, V_ordered, U, D, P_U, outcome, condition, intervention, skip_zero, keep_states
+    if len(blocks) == 1:
+        partials = [enumerate_blocks(*arguments, blocks)]
+    else:
+        runs = pool.chunks(len(blocks))
+        partials = pool.run(enumerate_blocks, [(*arguments, blocks[start:stop]) for start, stop in runs])
+
+    prob_outcome, normalizer, states = dict(), 0.0, dict()
+    for block_partials in partials:
+        for block_outcome, block_normalizer, block_states in block_partials:
+            normalizer += block_normalizer
+            for key, p in block_outcome.items():
+                prob_outcome[key] = prob_outcome.get(key, 0) + p
+            for state, p in block_states.items():
+                states[state] = states.get(state, 0) + p
+    return prob_outcome, normalizer, [dict(zip(V_ordered, state)) for state in sorted(states)]
+
+
+def expectation_blocks(
+    F: dict,
+    V_ordered: Sequence[str],
+    U: Sequence[str],
+    D: dict,
+    P_U: Callable,
+    reward_variable: str,
+    arms: Sequence[dict],
+    changed: Sequence[Sequence[str]],
+    skip_zero: bool,
+    blocks: List[Tuple[int, int]],
+) -> list:
+    """ The partial reward masses and normalizer of each (start, stop) block of U configurations """
+    return [
+        _expectations(F, V_ordered, U, D, P_U, reward_variable, arms, changed, skip_zero, ENUMERATION_CHUNK, *block)
+        for block in blocks
+    ]
+
+
+def parallel_expectations(
+    pool: TrialPool,
+    F: dict,
+    G,
+    U: Sequence[str],
+    D,
+    P_U: Callable,
+    reward_variable: str,
+    arms: Sequence[dict],
+    skip_zero=True,
+    block_size=PARALLEL_BLOCK,
+) -> Tuple[np.ndarray, float]:
+    """vectorized_expectations with the configurations of U split into blocks enumerated by the workers of pool, as
+    parallel_query does, whose result does not depend on the number of workers either"""
+    V_ordered, U, scale = ancestral_closure(F, G, U, D, P_U, [reward_variable], dict())
+    changed = arm_descendants(G, V_ordered, arms)
+    D = {V: tuple(D[V]) for V in list(U) + [reward_variable]}  # e.g. not a defaultdict of a lambda
+    n_configurations = int(np.prod([len(D[U_i]) for U_i in U]))
+    bounds = list(range(0, n_configurations, block_size)) + [n_configurations]
+    blocks = list(zip(bounds, bounds[1:]))
+    arguments = F, V_ordered, U, D, P_U, reward_variable, arms, changed, skip_zero
+    if len(blocks) == 1:
+        partials = [expectation_blocks(*arguments, blocks)]
+    else:
+        runs = pool.chunks(len(blocks))
+        partials = pool.run(expectation_blocks, [(*arguments, blocks[start:stop]) for start, stop in runs])
+
+    reward_mass, normalizer = np.zeros((len(arms),)), 0.0
+    for block_partials in partials:
+        for block_reward_mass, block_normalizer in block_partials:
+            reward_mass += block_reward_mass
+            normalizer += block_normalizer
+    return reward_mass * scale, normalizer * scale
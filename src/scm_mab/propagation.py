@@ -0,0 +1,122 @@
+import numpy as np
+from collections import defaultdict
+from typing import Iterator, List, Sequence, Tuple
+
+from scm_mab.inference import vectorized_slice
+
+""" Propagation, one time-slice at a time, of the states reached by the interventions replayed by query01 """
+
+
+class StateDistribution:
+    """
+    Weighted distribution over states, i.e. values of the endogenous variables of a time-slice.
+
+    Duplicate states are merged (summing their weights) and states whose values are all zero or one are bit-packed,
+    one bit per variable.
+
+    Parameters
+    ----------
+    variables : Sequence[str]
+        Endogenous variables, in the order of the columns of rows
+    rows : np.ndarray
+        (n, len(variables)) values of each state
+    weights : np.ndarray
+        (n,) weight of each state
+    """
+
+    def __init__(self, variables: Sequence[str], rows: np.ndarray, weights: np.ndarray):
+        self.variables = tuple(variables)
+        rows = np.asarray(rows).reshape(-1, len(self.variables))
+        unique, inverse = np.unique(rows, axis=0, return_inverse=True)
+        self.weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(unique))
+        self.binary = bool(np.isin(unique, (0, 1)).all())
+        if self.binary:
+            self.packed = np.packbits(unique.astype(bool), axis=1)
+        else:
+            self.values = unique
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __iter__(self) -> Iterator[Tuple[dict, float]]:
+        for row, weight in zip(self.rows.tolist(), self.weights.tolist()):
+            yield dict(zip(self.variables, row)), weight
+
+    @property
+    def rows(self) -> np.ndarray:
+        if self.binary:
+            return np.unpackbits(self.packed, axis=1, count=len(self.variables)).astype(np.int64)
+        return self.values
+
+    @property
+    def nbytes(self) -> int:
+        return self.weights.nbytes + (self.packed.nbytes if self.binary else self.values.nbytes)
+
+
+class SlicePropagation:
+    """
+    The time-slices played so far, summarized by the outcome masses and normalizer query01 accumulates over them and by
+    the distribution over the states they end in.
+
+    Each advance plays one more time-slice from every state of the distribution, so that it, and the expectations of the
+    arms of the next time-slice, cost O(states x U-configurations) whatever the number of time-slices before.
+
+    Parameters
+    ----------
+    reward_variable : str
+        Outcome whose masses are accumulated
+    weighted : bool
+        Weigh each state by its probability. By default every distinct state reached weighs one (even those reached
+        with probability zero), which is what query01 does by deduplicating them.
+    """
+
+    def __init__(self, reward_variable: str, weighted=False):
+        self.outcome = (reward_variable,)
+        self.weighted = weighted
+        self.prob_outcome = defaultdict(lambda: 0)
+        self.normalizer = 0.0
+        self.distribution = None  # before the first time-slice
+        self.interventions = []
+
+    def equations(self, M) -> List[Tuple[dict, float]]:
+        """ The equations of M for the next time-slice from each state, with the weight of the state """
+        if self.distribution is None:
+            return [(M.equations(), 1.0)]
+        return [(M.equations(state), weight) for state, weight in self.distribution]
+
+    def advance(self, M, intervention: dict) -> "SlicePropagation":
+        """ Play the next time-slice, of the StructuralCausalModel M, under intervention """
+        U = list(sorted(M.G.U | M.more_U))
+        V_ordered = M.G.causal_order()
+        rows, masses = [], []
+        for F, weight in self.equations(M):
+            prob_outcome, normalizer, reached, reached_masses = vectorized_slice(
+                F, V_ordered, U, M.D, M.P_U, self.outcome, intervention
+            )
+            self.normalizer += weight * normalizer
+            for key, p in prob_outcome.items():
+                self.prob_outcome[key] += weight * p
+            rows.append(reached)
+            masses.append(weight * reached_masses)
+
+        rows, masses = np.concatenate(rows), np.concatenate(masses)
+        if self.weighted:
+            kept = masses > 0
+            self.distribution = StateDistribution(V_ordered, rows[kept], masses[kept] / masses[kept].sum())
+        else:
+            self.distribution = StateDistribution(V_ordered, rows, np.ones((len(rows),)))
+            self.distribution.weights[:] = 1  # merged duplicates still weigh one
+        self.interventions.append(intervention)
+        return self
+
+    def expectations(self, M, arms: Sequence[dict]) -> np.ndarray:
+        """Expected reward of every arm in the next time-slice of M, as new_query of the interventions played so far
+        followed by the arm gives (with weighted=False)"""
+        reward_variable = self.outcome[0]
+        reward_mass = sum(y_val * self.prob_outcome[(y_val,)] for y_val in M.D[reward_variable])
+        normalizer = self.normalizer
+        for F, weight in self.equations(M):
+            arm_mass, arm_normalizer = M.arm_masses(F, reward_variable, arms, skip_zero=self.distribution is None)
+            reward_mass, normalizer = reward_mass + weight * arm_mass, normalizer + weight * arm_normalizer
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(normalizer > 0, reward_mass / normalizer, np.nan) * np.ones((len(arms),))
@@ -1,13 +1,14 @@
+import numpy as np
 from itertools import product
 from typing import Dict, Tuple, Union, Any
 from scm_mab.model import StructuralCausalModel
+from scm_mab.propagation import SlicePropagation
 from scm_mab.utils import combinations
 from scm_mab.where_do import POMISs, MISs
 
 
 def SCM_to_bandit_machine(M: StructuralCausalModel, target_variable="Y") -> Tuple[Tuple, Dict[Union[int, Any], Dict]]:
     G = M.G
-    mu_per_arm = list()  # Expected reward per arm
     arm_setting = dict()
     all_subsets = list(combinations(sorted(G.V - {target_variable})))
     arm_id = 0
@@ -16,23 +17,23 @@ def SCM_to_bandit_machine(M: StructuralCausalModel, target_variable="Y") -> Tupl
         for values in product(*[M.D[variable] for variable in subset]):
             #  E.g. Arm 1: do(X=1)
             arm_setting[arm_id] = dict(zip(subset, values))
-            #  Get causal effect at this time-index (if dynamic SEM)
-            result = M.query(outcome=(target_variable,), intervention=arm_setting[arm_id])
-            expectation = sum(y_val * result[(y_val,)] for y_val in M.D[target_variable])
-            mu_per_arm.append(expectation)
             arm_id += 1
 
-    return tuple(mu_per_arm), arm_setting
+    #  Get causal effect at this time-index (if dynamic SEM), for all arms at once
+    mu_per_arm = M.expectations(target_variable, [arm_setting[arm_x] for arm_x in range(arm_id)])
+    return tuple(mu_per_arm.tolist()), arm_setting
 
 
 def new_SCM_to_bandit_machine(
     M: StructuralCausalModel,
     interventions: list = None,
     reward_variable: str = "Y",
+    propagation: SlicePropagation = None,
+    approximate=False,
+    seed=None,
 ) -> Tuple[Tuple, Dict[Union[int, Any], Dict]]:
 
     G = M.G
-    mu_per_arm = list()  # Expected reward per arm
     arm_setting = dict()
     all_subsets = list(combinations(sorted(G.V - {reward_variable})))
     arm_id = 0
@@ -43,17 +44,23 @@ def new_SCM_to_bandit_machine(
     for subset in all_subsets:
         for values in product(*[M.D[variable] for variable in subset]):
             arm_setting[arm_id] = dict(zip(subset, values))
-            if interventions:
-                #  New way to intervene
-                result = M.new_query(outcome=(reward_variable,), interventions=interventions + [arm_setting[arm_id]])
-            else:
-                #  Old way to intervene
-                result = M.query(outcome=(reward_variable,), intervention=arm_setting[arm_id])
-            expectation = sum(y_val * result[(y_val,)] for y_val in M.D[reward_variable])
-            mu_per_arm.append(expectation)
             arm_id += 1
 
-    return tuple(mu_per_arm), arm_setting
+    #  New way to intervene (after the past interventions) if any, else the old way, for all arms at once
+    arms = [arm_setting[arm_x] for arm_x in range(arm_id)]
+    if propagation is not None:
+        # the past interventions are already played by propagation, one time-slice at a time
+        assert not interventions and propagation.outcome == (reward_variable,)
+        mu_per_arm = propagation.expectations(M, arms)
+    elif approximate:
+        # estimated from samples of the first time-slice, every arm sampling from the same seed (common random numbers)
+        assert not interventions, "Monte Carlo estimates are of the first time-slice only"
+        seed = np.random.SeedSequence(seed)
+        estimates = [M.monte_carlo_query((reward_variable,), intervention=arm, seed=seed) for arm in arms]
+        mu_per_arm = np.array([sum(y * estimate[(y,)] for y in M.D[reward_variable]) for estimate in estimates])
+    else:
+        mu_per_arm = M.expectations(reward_variable, arms, interventions)
+    return tuple(mu_per_arm.tolist()), arm_setting
 
 
 def arm_types():
@@ -0,0 +1,140 @@
+import numpy as np
+import operator
+from collections import OrderedDict
+from typing import Callable, Optional
+
+""" Symbolic tracing of scalar structural equations (dicts of lambdas over a dict of values) into array functions """
+
+
+class Traced:
+    """
+    Value of a structural equation being traced: an expression over the variables it reads.
+
+    Arithmetic, bitwise and comparison operators build larger expressions, while branching on a traced value (if, and,
+    or, not) raises a TypeError, as its outcome would depend on the values.
+
+    Parameters
+    ----------
+    evaluate : Callable
+        Value of the expression given lookup, a function from (kind, name) of a variable to its array of values
+    """
+
+    __array_ufunc__ = None  # numpy scalars defer to the reflected operators below
+
+    def __init__(self, evaluate: Callable):
+        self.evaluate = evaluate
+
+    def __bool__(self):
+        raise TypeError("cannot branch on a traced value")
+
+
+def _lift(x) -> Traced:
+    return x if isinstance(x, Traced) else Traced(lambda lookup: x)
+
+
+def _binary(op, reflected=False):
+    def method(self, other):
+        a, b = (_lift(other), self) if reflected else (self, _lift(other))
+        return Traced(lambda lookup: op(a.evaluate(lookup), b.evaluate(lookup)))
+
+    return method
+
+
+def _unary(op):
+    return lambda self: Traced(lambda lookup: op(self.evaluate(lookup)))
+
+
+for _name in ["xor", "and", "or", "add", "sub", "mul", "truediv", "floordiv", "mod", "pow", "lshift", "rshift"]:
+    _op = getattr(operator, _name if hasattr(operator, _name) else _name + "_")
+    setattr(Traced, f"__{_name}__", _binary(_op))
+    setattr(Traced, f"__r{_name}__", _binary(_op, reflected=True))
+for _name in ["eq", "ne", "lt", "le", "gt", "ge"]:
+    setattr(Traced, f"__{_name}__", _binary(getattr(operator, _name)))
+for _name in ["invert", "neg", "pos", "abs"]:
+    setattr(Traced, f"__{_name}__", _unary(getattr(operator, _name)))
+Traced.__hash__ = None
+
+
+class Symbols:
+    """ Variables dictionary whose values are the variables themselves, of a kind ("v" or "past") """
+
+    def __init__(self, kind="v"):
+        self.kind = kind
+
+    def __getitem__(self, name) -> Traced:
+        return Traced(lambda lookup: lookup(self.kind, name))
+
+    def get(self, name, default=None) -> Traced:
+        return self[name]
+
+
+def trace(f: Callable) -> Optional[Traced]:
+    """ The expression computed by a scalar structural equation, None if it cannot be traced (e.g. it branches) """
+    try:
+        return _lift(f(Symbols()))
+    except Exception:
+        return None
+
+
+def _time_slice(v: dict, t: int) -> Callable:
+    return lambda kind, name: v[name][:, t] if kind == "v" else v[name][:, t - 1]
+
+
+def vectorize_equation(f: Callable, row_equation: Callable = None) -> Callable:
+    """The (v, t) function of static_vec and dynamic_vec for a scalar equation f, v holding (N, T) arrays.
+
+    Equations which cannot be traced are evaluated one sample at a time, by row_equation(v, t, i) if given (which is
+    needed if f was made from symbols of the past) or else by f on the values of sample i at time t.
+    """
+    expression = trace(f)
+    if expression is not None:
+        return lambda v, t: expression.evaluate(_time_slice(v, t))
+
+    def sample_equation(v, t, i):
+        if row_equation is not None:
+            return row_equation(v, t, i)
+        return f({name: values[i, t] for name, values in v.items()})
+
+    return lambda v, t: np.array([sample_equation(v, t, i) for i in range(len(next(iter(v.values()))))])
+
+
+class VectorizedSEM:
+    """
+    A SEM defining only the scalar static() and dynamic(past), with static_vec() and dynamic_vec(clamped) made by
+    tracing them, as hand-written for DynamicIVCD.
+
+    dynamic_vec(None) traces dynamic on symbols of the previous time-slice, whose values are then those at t - 1.
+
+    Parameters
+    ----------
+    SEM
+        SEM class (or instance) with static and dynamic methods
+    """
+
+    def __init__(self, SEM):
+        self.SEM = SEM
+
+    def __getattr__(self, name):
+        return getattr(self.SEM, name)
+
+    def static_vec(self) -> OrderedDict:
+        return OrderedDict((V_i, vectorize_equation(f)) for V_i, f in self.SEM.static().items())
+
+    def dynamic_vec(self, clamped: dict = None) -> OrderedDict:
+        if clamped is not None:
+            return OrderedDict((V_i, vectorize_equation(f)) for V_i, f in self.SEM.dynamic(clamped).items())
+
+        def row_equation(V_i):
+            def equation(v, t, i):
+                past = {name: values[i, t - 1] for name, values in v.items()}
+                return self.SEM.dynamic(past)[V_i]({name: values[i, t] for name, values in v.items()})
+
+            return equation
+
+        F = self.SEM.dynamic(Symbols("past"))
+        return OrderedDict((V_i, vectorize_equation(f, row_equation(V_i))) for V_i, f in F.items())
+
+
+def vectorized_sem(SEM):
+    """ SEM itself if it has hand-written static_vec and dynamic_vec, else its VectorizedSEM """
+    return SEM if hasattr(SEM, "static_vec") and hasattr(SEM, "dynamic_vec") else VectorizedSEM(SEM)
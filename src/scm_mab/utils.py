@@ -29,14 +29,28 @@ def subseq(xs, indices):
         return [xs[i] for i in indices]
 
 
-def pick_randomly(xs):
-    return xs[np.random.randint(len(xs))]
+def as_generator(seed=None) -> np.random.Generator:
+    """A Generator seeded with an int or a SeedSequence, an existing Generator is returned as is"""
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
 
 
-def rand_argmax(xs):
+def spawn_seeds(seed, n: int) -> List[np.random.SeedSequence]:
+    """n independent child seeds of a root seed, e.g. one random stream per trial"""
+    return np.random.SeedSequence(seed).spawn(n)
+
+
+def pick_randomly(xs, rng: np.random.Generator = None):
+    if rng is None:
+        return xs[np.random.randint(len(xs))]
+    return xs[rng.integers(len(xs))]
+
+
+def rand_argmax(xs, rng: np.random.Generator = None):
     max_val = np.nanmax(xs)
     if max_val is np.nan:
-        return pick_randomly(np.arange(len(xs)))
+        return pick_randomly(np.arange(len(xs)), rng)
 
     max_indices = np.where(xs == max_val)[0]
     if not len(max_indices):
@@ -45,7 +59,22 @@ def rand_argmax(xs):
     if len(max_indices) == 1:
         return max_indices[0]
     else:
-        return pick_randomly(max_indices)
+        return pick_randomly(max_indices, rng)
+
+
+def rand_argmax_rows(xs: np.ndarray, rng: np.random.Generator = None) -> np.ndarray:
+    """Row-wise argmax of a 2D array where ties within a row are broken uniformly at random"""
+    is_max = xs == np.max(xs, axis=1, keepdims=True)
+    if np.count_nonzero(is_max) == len(xs):
+        # no ties (the usual case) so spare the extra random draws
+        return np.argmax(is_max, axis=1)
+    noise = np.random.rand(*xs.shape) if rng is None else rng.random(xs.shape)
+    return np.argmax(is_max * (1 + noise), axis=1)
+
+
+def arm_dtype(n_arms: int) -> np.dtype:
+    """Smallest unsigned integer type which holds the indices of n_arms arms"""
+    return np.min_scalar_type(max(n_arms - 1, 0))
 
 
 def with_default(x, dflt=None):
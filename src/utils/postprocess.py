@@ -1,14 +1,24 @@
 from typing import OrderedDict
 from scm_mab.NIPS2018POMIS_exp.test_bandit_strategies import compute_cumulative_regret, compute_optimality
+from scm_mab.history import BanditHistory
 import numpy as np
 from scipy.stats import bernoulli
 
 
 def get_results(arm_played, rewards, mu):
+    """arm_played may be a BanditHistory (and rewards None), whose probability of optimal play and frequencies are
+    computed from its encoding"""
+    history = arm_played if isinstance(arm_played, BanditHistory) else None
+    if history is not None:
+        arm_played, rewards = history
     results = dict()
     mu_star = np.max(mu)
     results["cumulative_regret"] = compute_cumulative_regret(rewards, mu_star, remove_negative_cr=False)
     results["arm_optimality"] = compute_optimality(arm_played, mu)
+    if history is not None:
+        results["prob_arm_optimality"] = history.prob_arm_optimality(mu)
+        results["frequency"] = history.frequency()
+        return results
     results["prob_arm_optimality"] = np.mean(results["arm_optimality"], axis=0)
     unique, counts = np.unique(arm_played, return_counts=True)
     results["frequency"] = dict(zip(unique, counts))
@@ -16,6 +26,16 @@ def get_results(arm_played, rewards, mu):
     return results
 
 
+def get_identification_results(arm_identified, stopping_times, mu):
+    results = dict()
+    results["stopping_time"] = stopping_times
+    results["prob_correct"] = np.mean(compute_optimality(arm_identified, mu))
+    unique, counts = np.unique(arm_identified, return_counts=True)
+    results["frequency"] = dict(zip(unique, counts))
+
+    return results
+
+
 def implement_intervention(causal_order: tuple, F: OrderedDict, mu1: dict, intervention: dict, acausal=False) -> dict:
     assert isinstance(intervention, dict)
     assert (
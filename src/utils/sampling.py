@@ -1,5 +1,6 @@
 import numpy as np
 from scipy.stats import bernoulli
+from scm_mab.tracer import vectorized_sem
 
 
 def sample_sem(
@@ -14,7 +15,7 @@ def sample_sem(
         Sequential sample(s) from SEM.
     """
 
-    SEM = sem()
+    SEM = vectorized_sem(sem())  # traced if static_vec and dynamic_vec are not written out
     #  We use the vectorised version where we can sample N >= 1 per call, as this is faster.
     static = SEM.static_vec()
     dynamic = SEM.dynamic_vec()